@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""离线解析性能测试
+
+在fixtures文件夹中保存搜索结果页，每个页面为一个<名称>.html文件，如original.html、retweet.html、
+long_text.html、pics.html、video.html、empty.html，不需要联网即可测试SearchSpider.parse和parse_weibo的速度，
+并检查解析结果是否与<名称>.golden.json一致。fixtures中自带按页面结构合成的上述页面及其golden文件，
+golden文件与原始解析代码的结果一致，修改解析代码后运行run即可确认结果不变；也可以用record保存真实页面。
+
+在项目根目录下运行：
+    python benchmarks/parse_benchmark.py record original "https://s.weibo.com/weibo?q=..."  # 用settings.py中的cookie保存页面
+    python benchmarks/parse_benchmark.py update                                           # 以当前解析结果生成golden文件
+    python benchmarks/parse_benchmark.py run -n 50                                        # 测试速度并检查解析结果
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrapy.http import HtmlResponse
+from scrapy.http import Request as ScrapyRequest
+from scrapy.utils.project import get_project_settings
+from weibo.items import WeiboItem
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fixtures')
+
+
+def load_fixtures(fixture_dir):
+    """读取全部页面，返回[(名称, response)]"""
+    fixtures = []
+    if not os.path.isdir(fixture_dir):
+        return fixtures
+    for file_name in sorted(os.listdir(fixture_dir)):
+        if not file_name.endswith('.html'):
+            continue
+        with open(os.path.join(fixture_dir, file_name), 'rb') as f:
+            body = f.read()
+        url = 'https://s.weibo.com/weibo?q=benchmark&page=2'
+        request = ScrapyRequest(url,
+                                meta={
+                                    'base_url': 'https://s.weibo.com/weibo?q=benchmark',
+                                    'keyword': 'benchmark',
+                                    'start_time': datetime(2020, 1, 1, 0),
+                                    'end_time': datetime(2020, 1, 1, 1),
+                                    'page': 2
+                                })
+        response = HtmlResponse(url,
+                                body=body,
+                                encoding='utf-8',
+                                request=request)
+        fixtures.append((file_name[:-len('.html')], response))
+    return fixtures
+
+
+def parse_items(spider, response):
+    """返回parse_weibo解析出的微博，每条为包含关键词、可写入json的dict"""
+    items = []
+    for item in spider.parse_weibo(response):
+        weibo = item.to_dict()
+        if weibo['created_at']:
+            weibo['created_at'] = weibo['created_at'].isoformat()
+        weibo['pics'] = list(weibo['pics'])
+        weibo['keyword'] = item.keyword
+        items.append(weibo)
+    return items
+
+
+def golden_path(fixture_dir, name):
+    return os.path.join(fixture_dir, name + '.golden.json')
+
+
+def update(spider, fixtures, fixture_dir):
+    """以当前解析结果生成golden文件"""
+    for name, response in fixtures:
+        with open(golden_path(fixture_dir, name), 'w', encoding='utf-8') as f:
+            json.dump(parse_items(spider, response),
+                      f,
+                      ensure_ascii=False,
+                      indent=2)
+        print('已生成%s' % golden_path(fixture_dir, name))
+
+
+def check(spider, fixtures, fixture_dir, ignore):
+    """逐字段比较解析结果与golden文件，返回不一致的数量"""
+    errors = 0
+    for name, response in fixtures:
+        path = golden_path(fixture_dir, name)
+        if not os.path.isfile(path):
+            print('%s: 没有golden文件，跳过检查' % name)
+            continue
+        with open(path, encoding='utf-8') as f:
+            expected = json.load(f)
+        actual = parse_items(spider, response)
+        if len(actual) != len(expected):
+            print('%s: 微博数量为%d，应为%d' % (name, len(actual), len(expected)))
+            errors += 1
+        for i, (a, e) in enumerate(zip(actual, expected)):
+            for key in sorted(set(a) | set(e)):
+                if key not in ignore and a.get(key) != e.get(key):
+                    print('%s: 第%d条微博的%s为%r，应为%r' %
+                          (name, i + 1, key, a.get(key), e.get(key)))
+                    errors += 1
+    return errors
+
+
+def parse_all(fixtures, func, iterations):
+    """重复解析全部页面，返回(页数, 微博数)"""
+    pages = 0
+    items = 0
+    for _ in range(iterations):
+        for _, response in fixtures:
+            # 每次重新解析页面，避免使用scrapy缓存的选择器
+            response = response.replace(body=response.body)
+            items += sum(1 for x in func(response) if isinstance(x, WeiboItem))
+            pages += 1
+    return pages, items
+
+
+def benchmark(label, fixtures, func, iterations):
+    """重复解析全部页面，输出每秒页数、每秒微博数和Python对象的内存峰值（不含lxml在C中分配的内存）。
+    tracemalloc会拖慢每次内存分配，计时和测量内存分两遍进行，内存只需解析一遍"""
+    start = time.perf_counter()
+    pages, items = parse_all(fixtures, func, iterations)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    parse_all(fixtures, func, 1)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('%-12s %8.1f 页/秒 %10.1f 条/秒 Python内存峰值 %.1f MB' %
+          (label, pages / elapsed, items / elapsed, peak / 1024 / 1024))
+
+
+def record(name, url, fixture_dir):
+    """使用settings.py中的请求头保存一个搜索结果页"""
+    settings = get_project_settings()
+    request = Request(url, headers=settings.get('DEFAULT_REQUEST_HEADERS'))
+    with urlopen(request) as response:
+        body = response.read()
+    if not os.path.isdir(fixture_dir):
+        os.makedirs(fixture_dir)
+    with open(os.path.join(fixture_dir, name + '.html'), 'wb') as f:
+        f.write(body)
+    print('已保存%s.html' % name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线解析性能测试')
+    parser.add_argument('--fixtures', default=FIXTURE_DIR, help='页面所在文件夹')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='测试速度并检查解析结果')
+    run_parser.add_argument('-n',
+                            '--iterations',
+                            type=int,
+                            default=20,
+                            help='重复解析全部页面的次数')
+    run_parser.add_argument('--ignore',
+                            action='append',
+                            default=[],
+                            help='检查时忽略的字段，如相对时间生成的created_at，可写多次')
+    subparsers.add_parser('update', help='以当前解析结果生成golden文件')
+    record_parser = subparsers.add_parser('record', help='保存一个搜索结果页')
+    record_parser.add_argument('name')
+    record_parser.add_argument('url')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.name, args.url, args.fixtures)
+        return
+
+    from weibo.spiders.search import SearchSpider
+    spider = SearchSpider()
+    fixtures = load_fixtures(args.fixtures)
+    if not fixtures:
+        sys.exit('%s中没有页面，请先用record保存页面' % args.fixtures)
+    if args.command == 'update':
+        update(spider, fixtures, args.fixtures)
+        return
+
+    errors = check(spider, fixtures, args.fixtures, set(args.ignore))
+    benchmark('parse', fixtures, spider.parse, args.iterations)
+    benchmark('parse_weibo', fixtures, spider.parse_weibo, args.iterations)
+    if errors:
+        sys.exit('解析结果与golden文件有%d处不一致' % errors)
+
+
+if __name__ == '__main__':
+    main()
@@ -311,7 +311,7 @@ class SearchSpider(scrapy.Spider):
 
             # extract different info
             if info:
-                weibo = WeiboItem()
+                weibo = {}
                 weibo['id'] = sel.xpath('@mid').extract_first()
                 try:
                     weibo['bid'] = sel.xpath(
@@ -435,7 +435,7 @@ class SearchSpider(scrapy.Spider):
                 weibo['retweet_id'] = ''
                 if retweet_sel and retweet_sel[0].xpath(
                         './/div[@node-type="feed_list_forwardContent"]/a[1]'):
-                    retweet = WeiboItem()
+                    retweet = {}
                     retweet['id'] = retweet_sel[0].xpath(
                         './/a[@action-type="feed_list_like"]/@action-data'
                     ).extract_first()[4:]
@@ -497,7 +497,7 @@ class SearchSpider(scrapy.Spider):
                     retweet['pics'] = pics
                     retweet['video_url'] = video_url
                     retweet['retweet_id'] = ''
-                    yield {'weibo': retweet, 'keyword': keyword}
+                    yield WeiboItem.from_dict(retweet, keyword)
                     weibo['retweet_id'] = retweet['id']
                 self.counting = self.counting + 1
 
@@ -507,7 +507,7 @@ class SearchSpider(scrapy.Spider):
                     logger.info(weibo)
                     print(weibo)
                     print('work in progress. posts count: ' + str(self.counting))
-                yield {'weibo': weibo, 'keyword': keyword}
+                yield WeiboItem.from_dict(weibo, keyword)
 
     def close(self, reason):
         """Record program duration"""
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Define here your extensions
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import sqlite3
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+from weibo.utils.dedup import make_dirs
+from weibo.utils.util import format_timescope
+
+# 爬虫解析完一个搜索结果页的概况后发送，参数为response和parser.parse_page的结果result
+page_parsed = object()
+# 爬虫保存搜索进度前发送，缓存结果的pipeline收到后写入缓存，处理函数可以返回Deferred，
+# 写入完成后才把页面标记为已完成，保证恢复时跳过的页面的微博都已写入
+checkpoint = object()
+
+
+class WindowStats(object):
+    """按(关键词, 地区, 时间窗口)统计页数、微博显示的总页数、微博数、重复数和平均下载延迟，每WINDOW_STATS_INTERVAL秒
+    及结束时写入WINDOW_STATS_FILE，写入后的窗口不再保留在内存中。每个窗口保留最近一次搜索的结果，RESUME时在上次的基础上累加"""
+
+    def __init__(self, file_path, resume=False, interval=60):
+        self.file_path = file_path
+        self.resume = resume
+        self.interval = interval
+        self.windows = {}
+        self.written = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        file_path = crawler.settings.get('WINDOW_STATS_FILE')
+        if not file_path:
+            raise NotConfigured
+        ext = cls(file_path, crawler.settings.getbool('RESUME'),
+                  crawler.settings.getfloat('WINDOW_STATS_INTERVAL', 60))
+        crawler.signals.connect(ext.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(ext.response_received,
+                                signal=signals.response_received)
+        crawler.signals.connect(ext.page_parsed, signal=page_parsed)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(ext.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(ext.spider_closed,
+                                signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        make_dirs(self.file_path)
+        self.db = sqlite3.connect(self.file_path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS window_stats (
+            keyword TEXT NOT NULL,
+            region TEXT NOT NULL,
+            timescope TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            pages INTEGER NOT NULL,
+            page_count INTEGER NOT NULL,
+            items INTEGER NOT NULL,
+            duplicates INTEGER NOT NULL,
+            latency REAL NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (keyword, region, timescope)
+            )""")
+        self.db.commit()
+        self.started_at = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(self.interval, now=False)
+
+    def window(self, meta):
+        """返回搜索结果页所属窗口的统计，不是搜索结果页时返回None"""
+        if 'start_time' not in meta:
+            return None
+        key = (meta['keyword'], meta['base_url'].partition('&region=')[2],
+               format_timescope(meta['start_time'], meta['end_time']))
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = {
+                'start_time': meta['start_time'],
+                'end_time': meta['end_time'],
+                'pages': 0,
+                'page_count': 0,
+                'items': 0,
+                'duplicates': 0,
+                'latency': 0.0
+            }
+        return window
+
+    def response_received(self, response, request, spider):
+        window = self.window(request.meta)
+        if window is not None:
+            window['pages'] += 1
+            window['latency'] += request.meta.get('download_latency', 0)
+
+    def page_parsed(self, response, result, spider):
+        window = self.window(response.meta)
+        if window is not None and response.meta.get('page') == 1:
+            # 只有一页结果时页面上没有页码列表
+            window['page_count'] = 0 if result['is_empty'] else max(
+                result['page_count'], 1)
+
+    def item_scraped(self, item, response, spider):
+        window = self.window(response.meta)
+        if window is not None:
+            window['items'] += 1
+
+    def item_dropped(self, item, response, exception, spider):
+        window = self.window(response.meta)
+        if window is not None:
+            window['duplicates'] += 1
+
+    def flush(self):
+        """把内存中的窗口统计合并到WINDOW_STATS_FILE后清空。同一窗口可能分多次写入，
+        本次运行已写入过的记录（updated_at不早于本次启动时间）与新统计累加，更早的记录在非RESUME时被替换"""
+        if not self.windows:
+            return
+        merge = '1' if self.resume else 'updated_at >= ?12'
+
+        def merged(column, expr):
+            return '%s = CASE WHEN %s THEN %s ELSE excluded.%s END' % (
+                column, merge, expr, column)
+
+        sql = """INSERT INTO window_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (keyword, region, timescope) DO UPDATE SET
+            %s, %s, %s, %s, %s, updated_at = excluded.updated_at""" % (
+            merged(
+                'latency', '(latency * pages + excluded.latency * '
+                'excluded.pages) / max(pages + excluded.pages, 1)'),
+            merged('pages', 'pages + excluded.pages'),
+            merged('page_count', 'max(page_count, excluded.page_count)'),
+            merged('items', 'items + excluded.items'),
+            merged('duplicates', 'duplicates + excluded.duplicates'))
+        updated_at = time.strftime('%Y-%m-%d %H:%M:%S')
+        rows = [(keyword, region, timescope,
+                 w['start_time'].strftime('%Y-%m-%d %H:%M'),
+                 w['end_time'].strftime('%Y-%m-%d %H:%M'), w['pages'],
+                 w['page_count'], w['items'], w['duplicates'],
+                 w['latency'] / w['pages'] if w['pages'] else 0, updated_at)
+                for (keyword, region, timescope), w in self.windows.items()]
+        if not self.resume:
+            rows = [row + (self.started_at, ) for row in rows]
+        self.db.executemany(sql, rows)
+        self.db.commit()
+        self.written += len(self.windows)
+        self.windows = {}
+
+    def spider_closed(self, spider):
+        if self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        self.db.close()
+        spider.logger.info('已向%s写入%d次时间窗口统计' %
+                           (self.file_path, self.written))
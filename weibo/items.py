@@ -5,25 +5,65 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
 
-import scrapy
-
-
-class WeiboItem(scrapy.Item):
-    # define the fields for your item here like:
-    id = scrapy.Field()
-    bid = scrapy.Field()
-    user_id = scrapy.Field()
-    screen_name = scrapy.Field()
-    text = scrapy.Field()
-    article_url = scrapy.Field()
-    location = scrapy.Field()
-    at_users = scrapy.Field()
-    topics = scrapy.Field()
-    reposts_count = scrapy.Field()
-    comments_count = scrapy.Field()
-    attitudes_count = scrapy.Field()
-    created_at = scrapy.Field()
-    source = scrapy.Field()
-    pics = scrapy.Field()
-    video_url = scrapy.Field()
-    retweet_id = scrapy.Field()
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Tuple
+
+from weibo.utils.util import normalize_count, parse_created_at
+
+# 微博本身的字段，即写入csv文件和数据库的字段，顺序与csv表头一致
+WEIBO_FIELDS = ('id', 'bid', 'user_id', 'screen_name', 'text', 'article_url',
+                'location', 'at_users', 'topics', 'reposts_count',
+                'comments_count', 'attitudes_count', 'created_at', 'source',
+                'pics', 'video_url', 'retweet_id')
+
+
+@dataclass
+class WeiboItem:
+    """一条微博，数量为整数，发布时间为时间类型（无法解析时为None），图片为url元组，keyword为搜索到该微博的关键词"""
+    __slots__ = WEIBO_FIELDS + ('keyword', )
+
+    id: str
+    bid: str
+    user_id: str
+    screen_name: str
+    text: str
+    article_url: str
+    location: str
+    at_users: str
+    topics: str
+    reposts_count: int
+    comments_count: int
+    attitudes_count: int
+    created_at: Optional[datetime]
+    source: str
+    pics: Tuple[str, ...]
+    video_url: str
+    retweet_id: str
+    keyword: str
+
+    @classmethod
+    def from_dict(cls, weibo, keyword):
+        """由parser解析出的字符串字段生成微博，只在此处转换一次类型"""
+        return cls(id=weibo['id'],
+                   bid=weibo['bid'],
+                   user_id=weibo['user_id'],
+                   screen_name=weibo['screen_name'],
+                   text=weibo['text'],
+                   article_url=weibo['article_url'],
+                   location=weibo['location'],
+                   at_users=weibo['at_users'],
+                   topics=weibo['topics'],
+                   reposts_count=normalize_count(weibo['reposts_count']),
+                   comments_count=normalize_count(weibo['comments_count']),
+                   attitudes_count=normalize_count(weibo['attitudes_count']),
+                   created_at=parse_created_at(weibo['created_at']),
+                   source=weibo['source'],
+                   pics=tuple(weibo['pics'] or ()),
+                   video_url=weibo['video_url'],
+                   retweet_id=weibo['retweet_id'],
+                   keyword=keyword)
+
+    def to_dict(self):
+        """返回微博本身的字段，不包含keyword"""
+        return {key: getattr(self, key) for key in WEIBO_FIELDS}
@@ -5,55 +5,282 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
-import copy
 import csv
+import hashlib
+import json
+import logging
 import os
+import time
+from io import BytesIO
+from urllib.parse import urlparse
 
 import scrapy
 from scrapy.exceptions import DropItem
-from scrapy.pipelines.files import FilesPipeline
+from scrapy.pipelines.files import FilesPipeline, FSFilesStore
 from scrapy.pipelines.images import ImagesPipeline
 from scrapy.utils.project import get_project_settings
+from twisted.enterprise import adbapi
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from weibo.extensions import checkpoint
+from weibo.items import WEIBO_FIELDS
+from weibo.utils.dedup import get_id_set, make_dirs
+from weibo.utils.media_index import MediaIndex
+from weibo.utils.thumbnails import ImageTranscoder
+from weibo.utils.video import VideoDownloader
 
 settings = get_project_settings()
+logger = logging.getLogger(__name__)
 
 
 class CsvPipeline(object):
+    """每个关键词的csv文件只打开一次，结果先缓存，每CSV_BATCH_SIZE条或每CSV_FLUSH_INTERVAL秒写入一次，
+    爬虫保存搜索进度前也会写入一次"""
+    header = [
+        'id', 'bid', 'user_id', '用户昵称', '微博正文', '头条文章url', '发布位置', '艾特用户',
+        '话题', '转发数', '评论数', '点赞数', '发布时间', '发布工具', '微博图片url', '微博视频url',
+        'retweet_id'
+    ]
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls()
+        crawler.signals.connect(pipeline.flush_all, signal=checkpoint)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.files = {}
+        self.buffers = {}
+        self.batch_size = settings.getint('CSV_BATCH_SIZE', 100)
+        self.flush_task = task.LoopingCall(self.flush_all)
+        self.flush_task.start(settings.getfloat('CSV_FLUSH_INTERVAL', 5),
+                              now=False)
+
+    def open_file(self, keyword):
+        """打开关键词对应的csv文件，新文件先写入表头"""
+        base_dir = '结果文件' + os.sep + keyword
+        if not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+        file_path = base_dir + os.sep + keyword + '.csv'
+        is_first_write = not os.path.isfile(file_path)
+        f = open(file_path, 'a', encoding='utf-8-sig', newline='')
+        writer = csv.writer(f)
+        if is_first_write:
+            writer.writerow(self.header)
+        self.files[keyword] = (f, writer)
+        self.buffers[keyword] = []
+
     def process_item(self, item, spider):
-        base_dir = '结果文件' + os.sep + item['keyword']
+        if item:
+            keyword = item.keyword
+            if keyword not in self.files:
+                self.open_file(keyword)
+            rows = self.buffers[keyword]
+            rows.append(self.row(item))
+            if len(rows) >= self.batch_size:
+                self.flush(keyword)
+        return item
+
+    def row(self, item):
+        """按表头顺序返回一行，发布时间和图片保持原来的csv格式"""
+        row = [getattr(item, key) for key in WEIBO_FIELDS]
+        created_at = WEIBO_FIELDS.index('created_at')
+        if row[created_at]:
+            row[created_at] = row[created_at].strftime('%Y-%m-%d %H:%M')
+        pics = WEIBO_FIELDS.index('pics')
+        row[pics] = list(row[pics]) if row[pics] else ''
+        return row
+
+    def flush(self, keyword):
+        """把关键词缓存的结果写入文件"""
+        rows = self.buffers[keyword]
+        if rows:
+            f, writer = self.files[keyword]
+            writer.writerows(rows)
+            f.flush()
+            self.buffers[keyword] = []
+
+    def flush_all(self):
+        for keyword in self.files:
+            self.flush(keyword)
+
+    def close_spider(self, spider):
+        if self.flush_task.running:
+            self.flush_task.stop()
+        self.flush_all()
+        for f, _ in self.files.values():
+            f.close()
+
+
+def json_default(value):
+    """把发布时间序列化为ISO 8601字符串"""
+    return value.isoformat()
+
+
+class JsonLinesPipeline(object):
+    """把字段类型化的微博逐行写入压缩的JSON Lines文件，JSONL_COMPRESSION为'zstd'、'gzip'或''（不压缩）。
+    每个关键词每次运行一个文件，中断时被截断的压缩流不会影响之后运行的结果，爬虫保存搜索进度前把压缩器中缓存的数据写入文件"""
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls()
+        crawler.signals.connect(pipeline.flush_all, signal=checkpoint)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.files = {}
+        self.compression = settings.get('JSONL_COMPRESSION', 'gzip')
+        self.run_time = time.strftime('%Y%m%d%H%M%S')
+        if self.compression == 'zstd':
+            try:
+                import zstandard
+                self.compressor = zstandard.ZstdCompressor(
+                    level=settings.getint('JSONL_COMPRESSION_LEVEL', 3))
+            except ImportError:
+                spider.zstandard_error = True
+
+    def open_file(self, keyword):
+        """新建关键词对应的jsonl文件，文件名包含运行时间，避免覆盖之前的结果"""
+        base_dir = '结果文件' + os.sep + keyword
         if not os.path.isdir(base_dir):
             os.makedirs(base_dir)
-        file_path = base_dir + os.sep + item['keyword'] + '.csv'
-        if not os.path.isfile(file_path):
-            is_first_write = 1
+        file_path = base_dir + os.sep + '%s_%s.jsonl' % (keyword,
+                                                         self.run_time)
+        if self.compression == 'zstd':
+            raw = open(file_path + '.zst', 'ab')
+            f = self.compressor.stream_writer(raw, closefd=True)
+        elif self.compression == 'gzip':
+            import gzip
+            f = gzip.open(file_path + '.gz', 'ab',
+                          settings.getint('JSONL_COMPRESSION_LEVEL', 6))
         else:
-            is_first_write = 0
-        if item:
-            with open(file_path, 'a', encoding='utf-8-sig', newline='') as f:
-                writer = csv.writer(f)
-                if is_first_write:
-                    header = [
-                        'id', 'bid', 'user_id', '用户昵称', '微博正文', '头条文章url',
-                        '发布位置', '艾特用户', '话题', '转发数', '评论数', '点赞数', '发布时间',
-                        '发布工具', '微博图片url', '微博视频url', 'retweet_id'
-                    ]
-                    writer.writerow(header)
-                writer.writerow(
-                    [item['weibo'][key] for key in item['weibo'].keys()])
+            f = open(file_path, 'ab')
+        self.files[keyword] = f
+        return f
+
+    def process_item(self, item, spider):
+        keyword = item.keyword
+        f = self.files.get(keyword) or self.open_file(keyword)
+        line = json.dumps(item.to_dict(),
+                          ensure_ascii=False,
+                          default=json_default)
+        f.write(line.encode('utf-8') + b'\n')
+        return item
+
+    def flush_all(self):
+        """结束当前压缩块并写入文件，之前写入的微博在程序中断后仍可读取"""
+        for f in self.files.values():
+            f.flush()
+
+    def close_spider(self, spider):
+        for f in self.files.values():
+            f.close()
+
+
+class ParquetPipeline(object):
+    """用pyarrow把字段类型化的微博写入Parquet文件，每个关键词每次运行一个文件，每PARQUET_ROW_GROUP_SIZE条写入一个行组。
+    Parquet文件关闭后才可读取，爬虫保存搜索进度前关闭当前文件，之后的结果写入新的分片文件"""
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls()
+        crawler.signals.connect(pipeline.close_writers, signal=checkpoint)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.writers = {}
+        self.rows = {}
+        self.parts = {}
+        self.row_group_size = settings.getint('PARQUET_ROW_GROUP_SIZE', 10000)
+        self.run_time = time.strftime('%Y%m%d%H%M%S')
+        try:
+            import pyarrow as pa
+            self.schema = pa.schema([
+                ('id', pa.string()),
+                ('bid', pa.string()),
+                ('user_id', pa.string()),
+                ('screen_name', pa.string()),
+                ('text', pa.string()),
+                ('article_url', pa.string()),
+                ('location', pa.string()),
+                ('at_users', pa.string()),
+                ('topics', pa.string()),
+                ('reposts_count', pa.int64()),
+                ('comments_count', pa.int64()),
+                ('attitudes_count', pa.int64()),
+                ('created_at', pa.timestamp('s')),
+                ('source', pa.string()),
+                ('pics', pa.list_(pa.string())),
+                ('video_url', pa.string()),
+                ('retweet_id', pa.string()),
+            ])
+        except ImportError:
+            spider.pyarrow_error = True
+
+    def open_writer(self, keyword):
+        """新建关键词对应的Parquet文件，文件名包含运行时间，避免覆盖之前的结果，同一次运行的后续分片加上序号"""
+        import pyarrow.parquet as pq
+
+        base_dir = '结果文件' + os.sep + keyword
+        if not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+        part = self.parts.get(keyword, 0)
+        self.parts[keyword] = part + 1
+        name = '%s_%s' % (keyword, self.run_time)
+        if part:
+            name += '_%d' % part
+        file_path = base_dir + os.sep + name + '.parquet'
+        self.writers[keyword] = pq.ParquetWriter(
+            file_path,
+            self.schema,
+            compression=settings.get('PARQUET_COMPRESSION', 'zstd'))
+
+    def process_item(self, item, spider):
+        keyword = item.keyword
+        rows = self.rows.setdefault(keyword, [])
+        rows.append(item.to_dict())
+        if len(rows) >= self.row_group_size:
+            self.flush(keyword)
         return item
 
+    def flush(self, keyword):
+        """把关键词缓存的结果写成一个行组"""
+        import pyarrow as pa
+
+        rows = self.rows[keyword]
+        if not rows:
+            return
+        if keyword not in self.writers:
+            self.open_writer(keyword)
+        self.writers[keyword].write_table(
+            pa.Table.from_pylist(rows, schema=self.schema))
+        self.rows[keyword] = []
+
+    def close_writers(self):
+        """写入所有缓存的结果并关闭当前的Parquet文件，之前写入的微博在程序中断后仍可读取"""
+        if not hasattr(self, 'schema'):
+            return
+        for keyword in self.rows:
+            self.flush(keyword)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def close_spider(self, spider):
+        self.close_writers()
+
 
 class MyImagesPipeline(ImagesPipeline):
     def get_media_requests(self, item, info):
-        if len(item['weibo']['pics']) == 1:
-            yield scrapy.Request(item['weibo']['pics'][0],
+        if len(item.pics) == 1:
+            yield scrapy.Request(item.pics[0],
                                  meta={
                                      'item': item,
                                      'sign': ''
                                  })
         else:
             sign = 0
-            for image_url in item['weibo']['pics']:
+            for image_url in item.pics:
                 yield scrapy.Request(image_url,
                                      meta={
                                          'item': item,
@@ -65,54 +292,320 @@ class MyImagesPipeline(ImagesPipeline):
         image_url = request.url
         item = request.meta['item']
         sign = request.meta['sign']
-        base_dir = '结果文件' + os.sep + item['keyword'] + os.sep + 'images'
-        if not os.path.isdir(base_dir):
-            os.makedirs(base_dir)
+        base_dir = '结果文件' + os.sep + item.keyword + os.sep + 'images'
         image_suffix = image_url[image_url.rfind('.'):]
-        file_path = base_dir + os.sep + item['weibo'][
-            'id'] + sign + image_suffix
+        file_path = base_dir + os.sep + item.id + sign + image_suffix
         return file_path
 
 
 class MyVideoPipeline(FilesPipeline):
     def get_media_requests(self, item, info):
-        if item['weibo']['video_url']:
-            yield scrapy.Request(item['weibo']['video_url'],
+        if item.video_url:
+            yield scrapy.Request(item.video_url,
                                  meta={'item': item})
 
     def file_path(self, request, response=None, info=None):
         item = request.meta['item']
-        base_dir = '结果文件' + os.sep + item['keyword'] + os.sep + 'videos'
-        if not os.path.isdir(base_dir):
-            os.makedirs(base_dir)
-        file_path = base_dir + os.sep + item['weibo']['id'] + '.mp4'
+        base_dir = '结果文件' + os.sep + item.keyword + os.sep + 'videos'
+        file_path = base_dir + os.sep + item.id + '.mp4'
         return file_path
 
 
+class WeiboMediaPipeline(FilesPipeline):
+    """下载微博图片和视频，文件按内容的sha1保存在FILES_STORE下的结果文件/media文件夹中，相同内容只保存一次。
+    MEDIA_INDEX_FILE记录已下载的url，多次运行和多个关键词间相同的url只下载一次。
+    每个关键词的media.csv记录微博id与文件的对应关系，图片请求使用名为media的下载槽，并发数由DOWNLOAD_SLOTS设置；
+    MEDIA_STREAM_VIDEOS为True且保存在本地时，视频不经过scrapy下载，而是流式写入文件并支持续传，同时下载的视频数为VIDEO_CONCURRENCY；
+    设置了MEDIA_THUMBNAILS或MEDIA_WEBP时，新下载的图片在进程池中生成缩略图或WebP文件，MEDIA_DROP_ORIGINALS为True时删除原图"""
+    manifest_header = ['id', 'type', 'url', 'path', 'sha1']
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        self.manifests = {}
+        self.media_index = MediaIndex(
+            settings.get('MEDIA_INDEX_FILE', 'crawls/media.db'))
+        self.video_downloader = None
+        self.video_jobs = {}
+        if settings.getbool('MEDIA_STREAM_VIDEOS', True) and isinstance(
+                self.store, FSFilesStore):
+            self.video_downloader = VideoDownloader(
+                settings.getint('VIDEO_CONCURRENCY', 2),
+                settings.get('USER_AGENT'),
+                settings.getfloat('VIDEO_TIMEOUT', 30))
+        self.image_transcoder = None
+        self.transcode_jobs = {}
+        thumbs = settings.getdict('MEDIA_THUMBNAILS')
+        webp = settings.getbool('MEDIA_WEBP')
+        if (thumbs or webp) and isinstance(self.store, FSFilesStore):
+            self.image_transcoder = ImageTranscoder(
+                self.store.basedir, thumbs, webp,
+                settings.getint('MEDIA_IMAGE_QUALITY', 80),
+                settings.getbool('MEDIA_DROP_ORIGINALS'),
+                settings.getint('MEDIA_PROCESSES') or None)
+
+    def process_item(self, item, spider):
+        if self.video_downloader and item.video_url:
+            self.stream_video(item)
+        return super().process_item(item, spider)
+
+    def get_media_requests(self, item, info):
+        urls = [(url, 'image') for url in item.pics]
+        if item.video_url and not self.video_downloader:
+            urls.append((item.video_url, 'video'))
+        requests = []
+        for url, media_type in dict(urls).items():
+            requests.append(
+                scrapy.Request(url,
+                               meta={
+                                   'download_slot': 'media',
+                                   'media_type': media_type
+                               }))
+        return requests
+
+    def stored(self, path):
+        """判断文件是否已保存，只能检查本地文件，其它存储方式返回False"""
+        return isinstance(self.store, FSFilesStore) and os.path.isfile(
+            os.path.join(self.store.basedir, path))
+
+    def media_to_download(self, request, info, *, item=None):
+        """在发出请求前查询索引，已下载过且文件仍存在的url不再下载"""
+        indexed = self.media_index.get(request.url)
+        if indexed and self.stored(indexed[0]):
+            self.inc_stats(info.spider, 'uptodate')
+            return {
+                'url': request.url,
+                'path': indexed[0],
+                'checksum': indexed[1],
+                'status': 'uptodate'
+            }
+        return None
+
+    def file_path(self, request, response=None, info=None, *, item=None):
+        """根据文件内容的sha1生成保存路径，如结果文件/media/ab/abcdef....jpg"""
+        if 'media_path' in request.meta:
+            return request.meta['media_path']
+        if response is None:
+            return super().file_path(request, info=info, item=item)
+        sha1 = hashlib.sha1(response.body).hexdigest()
+        request.meta['media_sha1'] = sha1
+        request.meta['media_path'] = self.content_path(
+            sha1, request.url, request.meta.get('media_type'))
+        return request.meta['media_path']
+
+    def content_path(self, sha1, url, media_type):
+        """返回内容为sha1的文件的保存路径，扩展名取自url"""
+        suffix = os.path.splitext(urlparse(url).path)[1]
+        if not suffix:
+            suffix = '.mp4' if media_type == 'video' else '.jpg'
+        return '/'.join(['结果文件', 'media', sha1[:2], sha1 + suffix])
+
+    def file_downloaded(self, response, request, info, *, item=None):
+        path = self.file_path(request, response=response, info=info, item=item)
+        # 转发微博等与已保存文件内容相同时不再写入
+        if not self.stored(path):
+            self.store.persist_file(path, BytesIO(response.body), info)
+        return request.meta['media_sha1']
+
+    def item_completed(self, results, item, info):
+        results = [result for ok, result in results if ok]
+        if self.image_transcoder is None:
+            return self.record_results(results, item)
+        d = defer.gatherResults(
+            [self.transcode_image(result, item) for result in results])
+        d.addCallback(self.record_results, item)
+        return d
+
+    def transcode_image(self, result, item):
+        """为新下载的图片生成缩略图和WebP文件，删除原图时把结果中的路径改为替代原图的文件"""
+        if result['status'] == 'uptodate' or result['url'] == item.video_url:
+            return defer.succeed(result)
+        sha1 = result['checksum']
+        # 同时下载的相同内容只处理一次
+        if sha1 not in self.transcode_jobs:
+            job = self.image_transcoder.submit(result['path'], sha1)
+            job.addBoth(self.transcode_finished, sha1)
+            self.transcode_jobs[sha1] = job
+        d = defer.Deferred()
+        self.transcode_jobs[sha1].addBoth(self.transcode_done, d)
+        d.addCallback(lambda path: dict(result, path=path))
+        d.addErrback(self.transcode_failed, result)
+        return d
+
+    def transcode_finished(self, path, sha1):
+        """处理完成后不再接受新的等待者，等待者都处理完结果后忽略共用的失败，错误已在各自的结果中记录"""
+        job = self.transcode_jobs.pop(sha1)
+        job.addErrback(lambda failure: None)
+        return path
+
+    def transcode_done(self, path, d):
+        """把处理结果或失败传给一个等待同一内容的结果，并原样传给之后的等待者"""
+        if isinstance(path, Failure):
+            d.errback(path)
+        else:
+            d.callback(path)
+        return path
+
+    def transcode_failed(self, failure, result):
+        logger.warning('处理图片失败: %s %s' %
+                       (result['url'], failure.getErrorMessage()))
+        return result
+
+    def record_results(self, results, item):
+        """把新下载的文件写入索引，并在media.csv中记录微博与文件的对应关系"""
+        rows = []
+        for result in results:
+            if result['status'] != 'uptodate':
+                self.media_index.add(result['url'], result['path'],
+                                     result['checksum'])
+            media_type = 'video' if result['url'] == item.video_url else 'image'
+            rows.append([
+                item.id, media_type, result['url'], result['path'],
+                result['checksum']
+            ])
+        if rows:
+            self.manifest(item.keyword).writerows(rows)
+        return item
+
+    def manifest(self, keyword):
+        """返回关键词对应的media.csv的writer，新文件先写入表头"""
+        if keyword not in self.manifests:
+            base_dir = '结果文件' + os.sep + keyword
+            if not os.path.isdir(base_dir):
+                os.makedirs(base_dir)
+            file_path = base_dir + os.sep + 'media.csv'
+            is_first_write = not os.path.isfile(file_path)
+            f = open(file_path, 'a', encoding='utf-8-sig', newline='')
+            writer = csv.writer(f)
+            if is_first_write:
+                writer.writerow(self.manifest_header)
+            self.manifests[keyword] = (f, writer)
+        return self.manifests[keyword][1]
+
+    def stream_video(self, item):
+        """在后台下载视频，同一url只下载一次，完成后写入索引和media.csv，
+        video_jobs只保存下载中的视频，下载期间引用同一url的微博等待该下载完成"""
+        url = item.video_url
+        d = self.video_jobs.get(url)
+        if d is None:
+            indexed = self.media_index.get(url)
+            if indexed and self.stored(indexed[0]):
+                self.video_completed(indexed, item)
+                return
+            part_path = os.path.join(
+                self.store.basedir, '结果文件', 'media', 'partial',
+                hashlib.sha1(url.encode('utf-8')).hexdigest() + '.part')
+            make_dirs(part_path)
+            # 下载可能同步结束并从video_jobs中移除，之后只通过d添加回调
+            d = self.video_jobs[url] = self.video_downloader.download(
+                url, part_path)
+            d.addCallback(self.video_downloaded, url, part_path)
+            d.addErrback(self.video_failed, url)
+            d.addBoth(self.video_finished, url)
+        d.addCallback(self.video_completed, item)
+
+    def video_downloaded(self, sha1, url, part_path):
+        """把下载完成的.part文件移动到按内容保存的路径，相同内容已存在时删除"""
+        path = self.content_path(sha1, url, 'video')
+        full_path = os.path.join(self.store.basedir, path)
+        if os.path.isfile(full_path):
+            os.remove(part_path)
+        else:
+            make_dirs(full_path)
+            os.replace(part_path, full_path)
+        self.media_index.add(url, path, sha1)
+        return path, sha1
+
+    def video_failed(self, failure, url):
+        """记录下载失败的视频，保留.part文件，之后的微博引用该url时重新下载"""
+        logger.warning('下载视频失败: %s %s' % (url, failure.getErrorMessage()))
+
+    def video_finished(self, result, url):
+        self.video_jobs.pop(url, None)
+        return result
+
+    def video_completed(self, result, item):
+        if result:
+            path, sha1 = result
+            self.manifest(item.keyword).writerow(
+                [item.id, 'video', item.video_url, path, sha1])
+        return result
+
+    def close_spider(self, spider):
+        """等待后台下载的视频完成后关闭文件"""
+        d = defer.DeferredList(list(self.video_jobs.values()))
+        d.addBoth(self.close_files)
+        return d
+
+    def close_files(self, _):
+        for f, _ in self.manifests.values():
+            f.close()
+        self.media_index.close()
+        if self.image_transcoder:
+            self.image_transcoder.close()
+        if self.video_downloader:
+            return self.video_downloader.close()
+
+
 class MongoPipeline(object):
+    """以无序bulk_write批量upsert微博，每MONGO_BATCH_SIZE条或每MONGO_FLUSH_INTERVAL秒写入一次，爬虫保存搜索进度前也会写入一次"""
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls()
+        crawler.signals.connect(pipeline.flush, signal=checkpoint)
+        return pipeline
+
     def open_spider(self, spider):
+        self.spider = spider
+        self.operations = []
+        self.batch_size = settings.getint('MONGO_BATCH_SIZE', 100)
         try:
+            import pymongo
             from pymongo import MongoClient
             self.client = MongoClient(settings.get('MONGO_URI'))
             self.db = self.client['weibo']
             self.collection = self.db['weibo']
+            self.collection.create_index('id', unique=True)
         except ModuleNotFoundError:
             spider.pymongo_error = True
+        except pymongo.errors.ServerSelectionTimeoutError:
+            spider.mongo_error = True
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(settings.getfloat('MONGO_FLUSH_INTERVAL', 5),
+                              now=False)
 
     def process_item(self, item, spider):
+        try:
+            from pymongo import UpdateOne
+
+            self.operations.append(
+                UpdateOne({'id': item.id}, {'$set': item.to_dict()},
+                          upsert=True))
+            if len(self.operations) >= self.batch_size:
+                self.flush()
+        except ModuleNotFoundError:
+            spider.pymongo_error = True
+        return item
+
+    def flush(self):
+        """把缓存的upsert操作一次性写入数据库"""
+        operations, self.operations = self.operations, []
+        if not operations or not hasattr(self, 'collection'):
+            return
         try:
             import pymongo
 
-            new_item = copy.deepcopy(item)
-            if not self.collection.find_one({'id': new_item['weibo']['id']}):
-                self.collection.insert_one(dict(new_item['weibo']))
-            else:
-                self.collection.update_one({'id': new_item['weibo']['id']},
-                                           {'$set': dict(new_item['weibo'])})
+            self.collection.bulk_write(operations, ordered=False)
         except pymongo.errors.ServerSelectionTimeoutError:
-            spider.mongo_error = True
+            self.spider.mongo_error = True
+        except pymongo.errors.BulkWriteError as e:
+            logger.error('写入MongoDB数据库失败: %s' %
+                         e.details.get('writeErrors'))
 
     def close_spider(self, spider):
+        if self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
         try:
             self.client.close()
         except AttributeError:
@@ -120,6 +613,17 @@ class MongoPipeline(object):
 
 
 class MysqlPipeline(object):
+    def __init__(self, dbpool=None):
+        # 可以传入已建好weibo表的adbapi连接池，如用sqlite3代替MySQL测试批量写入
+        self.dbpool = dbpool
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls()
+        pipeline.stats = crawler.stats
+        crawler.signals.connect(pipeline.checkpoint, signal=checkpoint)
+        return pipeline
+
     def create_database(self, mysql_config):
         """创建MySQL数据库"""
         import pymysql
@@ -157,6 +661,18 @@ class MysqlPipeline(object):
         self.cursor.execute(sql)
 
     def open_spider(self, spider):
+        self.spider = spider
+        if self.dbpool is None:
+            self.connect(spider)
+        self.batch = []
+        self.batch_size = settings.getint('MYSQL_BATCH_SIZE', 100)
+        self.writing = set()
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(settings.getfloat('MYSQL_FLUSH_INTERVAL', 5),
+                              now=False)
+
+    def connect(self, spider):
+        """创建MySQL数据库和表，并建立写入用的连接池"""
         try:
             import pymysql
             mysql_config = {
@@ -171,43 +687,128 @@ class MysqlPipeline(object):
             self.db = pymysql.connect(**mysql_config)
             self.cursor = self.db.cursor()
             self.create_table()
+            self.db.close()
+            # 写入在线程池中进行，不阻塞爬虫
+            self.dbpool = adbapi.ConnectionPool(
+                'pymysql',
+                cp_min=1,
+                cp_max=settings.getint('MYSQL_POOL_SIZE', 3),
+                cp_reconnect=True,
+                **mysql_config)
         except ImportError:
             spider.pymysql_error = True
         except pymysql.OperationalError:
             spider.mysql_error = True
 
     def process_item(self, item, spider):
-        data = dict(item['weibo'])
-        data['pics'] = ','.join(data['pics'])
-        keys = ', '.join(data.keys())
-        values = ', '.join(['%s'] * len(data))
-        sql = """INSERT INTO {table}({keys}) VALUES ({values}) ON
-                     DUPLICATE KEY UPDATE""".format(table='weibo',
-                                                    keys=keys,
-                                                    values=values)
-        update = ','.join([" {key} = {key}".format(key=key) for key in data])
-        sql += update
-        try:
-            self.cursor.execute(sql, tuple(data.values()))
-            self.db.commit()
-        except Exception:
-            self.db.rollback()
+        data = item.to_dict()
+        data['pics'] = ','.join(item.pics)
+        self.batch.append(data)
+        if len(self.batch) >= self.batch_size:
+            # 等待本批写入完成再返回，数据库较慢时对爬虫形成反压
+            d = self.flush()
+            d.addBoth(lambda _: item)
+            return d
         return item
 
+    def flush(self):
+        """在线程池中写入缓存的一批微博，返回写入完成时触发的Deferred"""
+        batch, self.batch = self.batch, []
+        if not batch or not self.dbpool:
+            return defer.succeed(None)
+        d = self.dbpool.runInteraction(self.write_batch, batch)
+        d.addCallbacks(self.count_failed, self.batch_failed,
+                       errbackArgs=(batch, ))
+        self.writing.add(d)
+        d.addBoth(self.finish_writing, d)
+        return d
+
+    def finish_writing(self, result, d):
+        self.writing.discard(d)
+        return result
+
+    def checkpoint(self):
+        """写入缓存的微博，返回此前所有批次都写入完成时触发的Deferred"""
+        self.flush()
+        return defer.DeferredList(list(self.writing))
+
+    def count_failed(self, failed_rows):
+        if failed_rows and getattr(self, 'stats', None):
+            self.stats.inc_value('mysql/failed_rows', failed_rows)
+
+    def batch_failed(self, failure, batch):
+        """整批写入失败，如连接断开或表结构不符"""
+        self.spider.logger.error('写入MySQL数据库失败: %s' %
+                                 failure.getErrorMessage())
+        self.count_failed(len(batch))
+
+    def write_batch(self, cursor, batch):
+        """用executemany写入一批微博，整批提交一次，整批失败时逐条写入以免一条错误数据拖累整批，返回写入失败的条数。
+        连接错误会使整批失败"""
+        dbapi = self.dbpool.dbapi
+        failed_rows = 0
+        groups = {}
+        for data in batch:
+            groups.setdefault(tuple(data.keys()), []).append(
+                tuple(data.values()))
+        for keys, values in groups.items():
+            sql = self.insert_sql(keys)
+            try:
+                cursor.executemany(sql, values)
+            except dbapi.Error:
+                for value in values:
+                    try:
+                        cursor.execute(sql, value)
+                    except dbapi.Error as e:
+                        # MySQL 2000以上的错误码为客户端错误，如连接断开，逐条重试没有意义
+                        if isinstance(e, dbapi.InterfaceError) or (
+                                e.args and isinstance(e.args[0], int)
+                                and e.args[0] >= 2000):
+                            raise
+                        self.spider.logger.error('写入MySQL数据库失败: id %s %s' %
+                                                 (value[keys.index('id')], e))
+                        failed_rows += 1
+        return failed_rows
+
+    def insert_sql(self, keys):
+        """生成插入语句，已存在的微博保持不变。MySQL使用ON DUPLICATE KEY UPDATE，"ON DUPLICATE"须在同一行，
+        pymysql才会把executemany合并为一条多行INSERT；其它数据库（如代替MySQL测试的sqlite3）使用ON CONFLICT DO NOTHING"""
+        dbapi = self.dbpool.dbapi if self.dbpool else None
+        placeholder = '?' if dbapi and dbapi.paramstyle == 'qmark' else '%s'
+        sql = """INSERT INTO {table}({keys}) VALUES ({values})""".format(
+            table='weibo',
+            keys=', '.join(keys),
+            values=', '.join([placeholder] * len(keys)))
+        if dbapi and dbapi.__name__ not in ('pymysql', 'MySQLdb'):
+            return sql + ' ON CONFLICT (id) DO NOTHING'
+        update = ','.join([" {key} = {key}".format(key=key) for key in keys])
+        return sql + ' ON DUPLICATE KEY UPDATE' + update
+
     def close_spider(self, spider):
-        try:
-            self.db.close()
-        except Exception:
-            pass
+        if self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        if not self.dbpool:
+            return
+        d = defer.DeferredList(list(self.writing))
+        d.addBoth(lambda _: self.dbpool.close())
+        return d
 
 
 class DuplicatesPipeline(object):
     def __init__(self):
-        self.ids_seen = set()
+        self.ids_seen = get_id_set(
+            settings.get('DUPLICATES_BACKEND', 'set'),
+            settings.get('DUPLICATES_FILE'),
+            settings.getint('BLOOM_CAPACITY', 1000000),
+            settings.getfloat('BLOOM_ERROR_RATE', 0.0001),
+            settings.get('REDIS_URL'), bool(settings.get('WORK_QUEUE')))
 
     def process_item(self, item, spider):
-        if item['weibo']['id'] in self.ids_seen:
+        if not self.ids_seen.add(item.id):
             raise DropItem("过滤重复微博: %s" % item)
         else:
-            self.ids_seen.add(item['weibo']['id'])
             return item
+
+    def close_spider(self, spider):
+        self.ids_seen.close()
@@ -1,15 +1,24 @@
 # -*- coding: utf-8 -*-
 import os
-import re
 import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from urllib.parse import unquote
 
 import scrapy
+import weibo.utils.parser as parser
 import weibo.utils.util as util
+from scrapy import signals
 from scrapy.exceptions import CloseSpider
+from scrapy.utils.defer import maybe_deferred_to_future
 from scrapy.utils.project import get_project_settings
+from weibo.extensions import checkpoint, page_parsed
 from weibo.items import WeiboItem
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from weibo.utils.empty_windows import EmptyWindowCache
+from weibo.utils.frontier import Frontier, HighWaterMarks
+from weibo.utils.work_queue import get_work_queue
 import logging
 
 # --- create log file --- #
@@ -48,6 +57,7 @@ class SearchSpider(scrapy.Spider):
     # get info from settings.py
     weibo_type = util.convert_weibo_type(settings.get('WEIBO_TYPE'))
     contain_type = util.convert_contain_type(settings.get('CONTAIN_TYPE'))
+    search_filters = weibo_type + contain_type
     regions = util.get_regions(settings.get('REGION'))
     base_url = 'https://s.weibo.com'
     start_date = settings.get('START_DATE',
@@ -56,92 +66,309 @@ class SearchSpider(scrapy.Spider):
     if util.str_to_time(start_date) > util.str_to_time(end_date):
         sys.exit('settings.py配置错误，START_DATE值应早于或等于END_DATE值，请重新配置settings.py')
     further_threshold = settings.get('FURTHER_THRESHOLD', 46)
+
+    # adaptive mode starts with windows of ADAPTIVE_WINDOW_DAYS days and only splits
+    # a window into days and then hours once its page count reaches further_threshold
+    adaptive_search = settings.get('ADAPTIVE_SEARCH', False)
+    if adaptive_search:
+        window_step = timedelta(days=settings.get('ADAPTIVE_WINDOW_DAYS', 1))
+    else:
+        window_step = timedelta(hours=1)
+
+    # when an hourly window still reaches further_threshold pages, search it again by
+    # province (national searches) and then by city (province searches)
+    region_drill_down = settings.get('REGION_DRILL_DOWN', False)
     mongo_error = False
     pymongo_error = False
     mysql_error = False
     pymysql_error = False
-
-    # initialize start and end dates in  yy-mm-dd-hh format
+    zstandard_error = False
+    pyarrow_error = False
+
+    # number of (keyword, region) searches whose windows are interleaved round-robin
+    # by start_requests, 1 keeps the plain keyword-by-keyword order
+    search_interleave = settings.get('SEARCH_INTERLEAVE', 16)
+
+    # number of worker processes parsing result pages, 0 parses them in the reactor thread
+    parse_processes = settings.getint('PARSE_PROCESSES', 0)
+    parse_pool = None
+
+    # on-disk record of pending and finished pages, opened in start_requests if FRONTIER_FILE is set
+    frontier = None
+
+    # windows known to have no results, opened in start_requests if EMPTY_WINDOWS_FILE is set
+    empty_windows = None
+
+    # in incremental mode each keyword is searched from the time its last complete run reached,
+    # minus an overlap for late-indexed posts, up to the current hour
+    high_water_marks = None
+    search_ranges = None
+    outstanding = None
+    # windows ending after this time are inside the overlap and are searched again even if cached as empty
+    recheck_from = None
+
+    # in distributed mode the (keyword, region, window) units are shared with other spider
+    # processes through WORK_QUEUE, and a unit is finished once all of its pages are
+    work_queue = None
+    unit_pages = None
+
+    # a page is only marked finished once the pipelines have processed all of its items:
+    # number of items of each response still in the pipelines, and responses whose parse has ended
+    page_items = None
+    finishing = None
+
+    # initialize start and end dates, searches cover [start_date 0:00, end_date 0:00)
     start_date = datetime.strptime(start_date, '%Y-%m-%d')
     end_date = datetime.strptime(end_date,
                                  '%Y-%m-%d')
-    start_str = start_date.strftime('%Y-%m-%d') + '-0'
-    end_str = end_date.strftime('%Y-%m-%d') + '-0'
-    end_date_2 = datetime.strptime(end_str, '%Y-%m-%d-%H')
-    start_date_2 = datetime.strptime(start_str, '%Y-%m-%d-%H')
 
-    # set up url variable and later it will be assigned as base_url + self.weibo_type + self.contain_type
-    # e.g. 'https://s.weibo.com/weibo?q=香港&typeall=1&suball=1'
-    constant_url = ''
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.page_items = Counter()
+        spider.finishing = set()
+        for signal in (signals.item_scraped, signals.item_dropped,
+                       signals.item_error):
+            crawler.signals.connect(spider.item_processed, signal=signal)
+        return spider
 
     def start_requests(self):
-        # iterate each keyword
-        for keyword in self.keyword_list:
-
-            # log keyword
-            logger.info('keyword searching: ' + keyword)
-
-            # for all provinces
-            if not self.settings.get('REGION') or '全部' in self.settings.get(
-                    'REGION'):
-
-                # construct url excluding start and end dates
-                base_url = 'https://s.weibo.com/weibo?q=%s' % keyword
-                url = base_url + self.weibo_type
-                self.constant_url = url + self.contain_type
-
-                # construct url in one-hour manner and perform search
-                # 2020-09-01-13:2020-09-01-14 means 2020-09-01 13:00 to 2020-09-01 14:00
-                # e.g. https://s.weibo.com/weibo?q=连花清瘟&typeall=1&suball=1&timescope=custom:2020-09-01-13:2020-09-01-14
-                # start_date should not exceed the end date
-                while self.start_date_2 < self.end_date_2:
-
-                    #  Note: If start date is 2020-09-01 and end date is 2020-09-02,
-                    #  the whole period starts from 2020-09-01-0 and ends at 2020-09-02-0
-                    for i in range(1, 25):
-                        # process start and end time
-                        start_str, end_str = self.date_processing()
-
-                        # construct url with start and end time in 1 hour
-                        start_url = self.constant_url + '&timescope=custom:{}:{}'.format(start_str, end_str)
-
-
-                        # make request to start_url and call parse method for its response
-                        yield scrapy.Request(url=start_url,
-                                             callback=self.parse,
-                                             meta={
-                                                 'base_url': base_url,
-                                                 'keyword': keyword
-                                             })
+        """Lazily yield the first-page request of every (keyword, region, window) unit,
+        interleaving search_interleave searches so that no single keyword floods the scheduler"""
+        # for all provinces
+        if not self.settings.get('REGION') or '全部' in self.settings.get(
+                'REGION'):
+            regions = [None]
+        else:
+            regions = list(self.regions.values())
+
+        # the work queue keeps the progress of a distributed run, so the per-process
+        # frontier and high-water marks are not used
+        distributed = bool(self.settings.get('WORK_QUEUE'))
+        if self.settings.getbool('INCREMENTAL') and not distributed:
+            self.high_water_marks = HighWaterMarks(
+                self.settings.get('INCREMENTAL_FILE', 'crawls/high_water.db'))
+            self.search_ranges = {}
+            self.outstanding = Counter()
+            self.recheck_from = {}
+
+        # with RESUME, re-enqueue the unfinished pages of the last run and skip every
+        # window it already started; otherwise start a fresh frontier
+        resume = False
+        if self.settings.get('FRONTIER_FILE') and not distributed:
+            self.frontier = Frontier(self.settings.get('FRONTIER_FILE'),
+                                     flush=self.flush_items)
+            resume = self.settings.getbool('RESUME')
+            if resume:
+                for keyword, region, timescope, page, url in self.frontier.pending():
+                    yield self.resume_request(keyword, region, timescope,
+                                              page, url)
             else:
-                # for each province
-                for region in self.regions.values():
-
-                    # construct region-based url without start and end time
-                    base_url = (
-                        'https://s.weibo.com/weibo?q={}&region=custom:{}:1000'
-                    ).format(keyword, region['code'])
-                    url = base_url + self.weibo_type
-                    self.constant_url = url + self.contain_type
-
-                    # same as above
-                    while self.start_date_2 < self.end_date_2:
-                        for i in range(1, 25):
-                            start_str, end_str = self.date_processing()
-                            start_url = self.constant_url + '&timescope=custom:{}:{}'.format(start_str, end_str)
-
-
-                            # add province in meta
-                            yield scrapy.Request(url=start_url,
-                                                 callback=self.parse,
-                                                 meta={
-                                                     'base_url': base_url,
-                                                     'keyword': keyword,
-                                                     'province': region
-                                                 })
-
-            # reset start date for next keyword
-            self.start_date_2 = datetime.strptime(self.start_str, '%Y-%m-%d-%H')
+                self.frontier.clear()
+
+        searches = (self.search_units(keyword, region)
+                    for keyword in self.keyword_list for region in regions)
+        # windows that returned no results in earlier runs are not requested again
+        if self.settings.get('EMPTY_WINDOWS_FILE'):
+            ttl = self.settings.get('EMPTY_WINDOW_TTL')
+            self.empty_windows = EmptyWindowCache(
+                self.settings.get('EMPTY_WINDOWS_FILE'),
+                float(ttl) * 3600 if ttl is not None else None,
+                1 if distributed else 500)
+
+        units = util.interleave(searches, self.search_interleave)
+        if distributed:
+            yield from self.queue_requests(units)
+            return
+        for keyword, region, (start_time, end_time, timescope) in units:
+            meta = self.search_meta(keyword, region)
+            if resume and self.frontier.contains(
+                    keyword, self.search_region(meta), timescope):
+                continue
+            if self.known_empty(keyword, self.search_region(meta), end_time,
+                                timescope):
+                continue
+            yield self.window_request(meta, start_time, end_time, timescope)
+
+    def queue_requests(self, units):
+        """Seed the work queue with the units of this process and then claim units, including those
+        seeded by other processes, until none is left"""
+        self.work_queue = get_work_queue(
+            self.settings.get('WORK_QUEUE'),
+            self.settings.get('WORK_QUEUE_NAME', 'weibo'),
+            self.settings.getfloat('WORK_QUEUE_LEASE', 1800))
+        self.unit_pages = Counter()
+        self.work_queue.seed(self.unit_keys(units))
+        while True:
+            unit = self.work_queue.claim()
+            if unit is None:
+                return
+            meta = self.unit_meta(*unit)
+            meta['unit'] = unit
+            yield self.window_request(meta, meta['start_time'],
+                                      meta['end_time'], unit[2])
+
+    def unit_keys(self, units):
+        """Yield the (keyword, region, timescope) keys of units not known to be empty"""
+        for keyword, region, (_, end_time, timescope) in units:
+            region = self.search_region(self.search_meta(keyword, region))
+            if self.known_empty(keyword, region, end_time, timescope):
+                continue
+            yield keyword, region, timescope
+
+    def known_empty(self, keyword, region, end_time, timescope):
+        """Return whether a window is cached as empty by an earlier run, windows in the incremental
+        overlap are never skipped as late-indexed posts may have appeared in them since"""
+        if not self.empty_windows:
+            return False
+        if self.recheck_from and end_time > self.recheck_from.get(
+                keyword, datetime.max):
+            return False
+        return self.empty_windows.contains(keyword, region,
+                                           self.search_filters, timescope)
+
+    def search_units(self, keyword, region):
+        """Yield the (keyword, region, window) units of one search in time order"""
+        # log keyword
+        logger.info('keyword searching: ' + keyword +
+                    (' ' + str(region['code']) if region else ''))
+
+        # one-hour windows (or window_step in adaptive mode), e.g. 2020-09-01-13:2020-09-01-14 means
+        # 2020-09-01 13:00 to 2020-09-01 14:00
+        # Note: If start date is 2020-09-01 and end date is 2020-09-02,
+        # the whole period starts from 2020-09-01-0 and ends at 2020-09-02-0
+        # the window table is built once per run and shared by every keyword and region
+        start_time, end_time = self.search_range(keyword)
+        for window in util.window_table(start_time, end_time,
+                                        self.window_step):
+            yield keyword, region, window
+
+    def search_range(self, keyword):
+        """Return the (start, end) period searched for keyword in this run"""
+        if not self.high_water_marks:
+            return self.start_date, self.end_date
+        if keyword not in self.search_ranges:
+            end_time = datetime.now().replace(minute=0,
+                                              second=0,
+                                              microsecond=0)
+            start_time = self.start_date
+            mark = self.high_water_marks.get(keyword, self.search_filters)
+            if mark:
+                overlap = timedelta(
+                    hours=self.settings.getfloat('INCREMENTAL_OVERLAP', 6))
+                # keep windows aligned to whole hours
+                start_time = min(mark - overlap, end_time).replace(minute=0)
+                self.recheck_from[keyword] = mark - overlap
+            logger.info('keyword %s searching from %s to %s' %
+                        (keyword, start_time, end_time))
+            self.search_ranges[keyword] = (start_time, end_time)
+        return self.search_ranges[keyword]
+
+    def search_meta(self, keyword, region=None):
+        """Build the meta of a national search, or of a province search if region is given"""
+        # url excluding type and time filters, e.g. 'https://s.weibo.com/weibo?q=香港'
+        if region:
+            base_url = self.region_base_url(keyword, region['code'])
+            return {'base_url': base_url, 'keyword': keyword, 'province': region}
+        base_url = 'https://s.weibo.com/weibo?q=%s' % keyword
+        return {'base_url': base_url, 'keyword': keyword}
+
+    def region_base_url(self, keyword, province_code, city_code=1000):
+        """Build the url of a region search excluding type and time filters, city code 1000 is the whole province"""
+        return 'https://s.weibo.com/weibo?q={}&region=custom:{}:{}'.format(
+            keyword, province_code, city_code)
+
+    def search_region(self, meta):
+        """Return the region filter of a search, e.g. 'custom:34:1000', or '' for a national search"""
+        return meta['base_url'].partition('&region=')[2]
+
+    def resume_request(self, keyword, region, timescope, page, url):
+        """Rebuild the request of an unfinished frontier page from its key"""
+        meta = self.unit_meta(keyword, region, timescope)
+        meta['page'] = page
+        if self.high_water_marks:
+            self.outstanding[keyword] += 1
+        return scrapy.Request(url=url, callback=self.page_callback(), meta=meta)
+
+    def unit_meta(self, keyword, region, timescope):
+        """Rebuild the meta of a search window from its (keyword, region, timescope) key"""
+        meta = {'keyword': keyword}
+        _, start_str, end_str = timescope.split(':')
+        meta['start_time'] = util.parse_hour(start_str)
+        meta['end_time'] = util.parse_hour(end_str)
+        if region:
+            _, province_code, city_code = region.split(':')
+            province = util.get_region_by_code(int(province_code))
+            meta['base_url'] = self.region_base_url(keyword, province_code,
+                                                    city_code)
+            meta['province'] = province
+            if int(city_code) != 1000:
+                for city, code in province['city'].items():
+                    if code == int(city_code):
+                        meta['city'] = city
+        else:
+            meta['base_url'] = self.search_meta(keyword)['base_url']
+        return meta
+
+    def track_page(self, meta, url):
+        """Record a requested page as pending in the frontier"""
+        if self.high_water_marks:
+            self.outstanding[meta['keyword']] += 1
+        if 'unit' in meta:
+            self.unit_pages[meta['unit']] += 1
+        if self.frontier:
+            self.frontier.add(
+                meta['keyword'], self.search_region(meta),
+                util.format_timescope(meta['start_time'], meta['end_time']),
+                meta['page'], url)
+
+    def record_empty(self, response):
+        """Remember a window whose first page has no results so later runs can skip it"""
+        meta = response.meta
+        if self.empty_windows and 'start_time' in meta and meta.get(
+                'page') == 1:
+            self.empty_windows.add(
+                meta['keyword'], self.search_region(meta),
+                self.search_filters,
+                util.format_timescope(meta['start_time'], meta['end_time']),
+                meta['end_time'])
+
+    def finish_page(self, response):
+        """Mark the page behind response as finished once its items have gone through the pipelines,
+        parse_offloaded builds all items of a page before Scrapy hands the first one to the pipelines"""
+        if self.page_items and self.page_items[response]:
+            self.finishing.add(response)
+        else:
+            self.mark_finished(response)
+
+    def item_processed(self, item, response, spider, **kwargs):
+        """Count an item that left the pipelines, scraped, dropped or failed, and finish its page after the last one"""
+        if response not in self.page_items:
+            return
+        self.page_items[response] -= 1
+        if not self.page_items[response]:
+            del self.page_items[response]
+            if response in self.finishing:
+                self.finishing.remove(response)
+                self.mark_finished(response)
+
+    def mark_finished(self, response):
+        """Mark the page behind response as finished in the frontier, the incremental page count and the work queue unit"""
+        if 'start_time' not in response.meta:
+            return
+        meta = response.meta
+        if self.high_water_marks:
+            self.outstanding[meta['keyword']] -= 1
+        if 'unit' in meta:
+            self.unit_pages[meta['unit']] -= 1
+            if not self.unit_pages[meta['unit']]:
+                del self.unit_pages[meta['unit']]
+                self.work_queue.finish(meta['unit'])
+        if self.frontier:
+            self.frontier.finish(
+                meta['keyword'], self.search_region(meta),
+                util.format_timescope(meta['start_time'], meta['end_time']),
+                meta['page'])
 
     def check_environment(self):
         """判断配置要求的软件是否已安装"""
@@ -157,31 +384,43 @@ class SearchSpider(scrapy.Spider):
         if self.mysql_error:
             print('系统中可能没有安装或正确配置MySQL数据库，请先根据系统环境安装或配置MySQL，再运行程序')
             raise CloseSpider()
+        if self.zstandard_error:
+            print('系统中可能没有安装zstandard库，请先运行 pip install zstandard ，再运行程序')
+            raise CloseSpider()
+        if self.pyarrow_error:
+            print('系统中可能没有安装pyarrow库，请先运行 pip install pyarrow ，再运行程序')
+            raise CloseSpider()
 
-    def parse(self, response):
+    def parse(self, response, result=None):
         """Construct urls for all result pages of each search with a specific timeslot(e.g.https://s.weibo.com/weibo?q=连花清瘟&typeall=1&suball=1&timescope=custom:2020-09-01-13:2020-09-01-14 )
-        recursively and call parse_weibo method to process each result page """
+        recursively and call parse_weibo method to process each result page.
+        result is the output of parser.parse_text when the page was already parsed in a worker process"""
 
         # retrieve keywords
         keyword = response.meta.get('keyword')
 
+        if result is None:
+            result = parser.parse_page(response.selector.root)
+        self.page_parsed(response, result)
+
         # whether the page is empty
-        is_empty = response.xpath(
-            '//div[@class="card card-no-result s-pt20b40"]')
+        is_empty = result['is_empty']
 
         # number of result pages for each search within a specific timeslot
-        page_count = len(response.xpath('//ul[@class="s-scroll"]/li'))
+        page_count = result['page_count']
 
         # empty
         if is_empty:
             # log empty warning
             logger.warning('当前页面搜索结果为空 '+response.url)
+            self.record_empty(response)
+            self.finish_page(response)
         else:
             # if 1-page result
             if page_count == 0:
                 try:
                     # period
-                    period = response.xpath('//span[@class="ctips"]//text()').extract_first()
+                    period = result['period']
 
                     # log 1 page result info
                     logger.info(
@@ -191,7 +430,7 @@ class SearchSpider(scrapy.Spider):
             else:
                 try:
                     # period_2
-                    period_2 = response.xpath('//span[@class="ctips"]//text()').extract_first()
+                    period_2 = result['period']
 
                     # log (page_count) results
                     logger.info(
@@ -200,17 +439,41 @@ class SearchSpider(scrapy.Spider):
                 except:
                     print("No period information or period information is abnormal")
 
+            # in adaptive mode a first page showing at least further_threshold pages means the
+            # window holds more posts than the site displays, so search its sub-windows instead
+            if self.adaptive_search and response.meta.get(
+                    'page') == 1 and page_count >= self.further_threshold:
+                sub_windows = util.split_time_window(
+                    response.meta['start_time'], response.meta['end_time'])
+                if sub_windows:
+                    for start_time, end_time in sub_windows:
+                        yield self.window_request(self.window_meta(response),
+                                                  start_time, end_time)
+                    self.finish_page(response)
+                    return
+
+            # a saturated window that cannot be split in time any more is searched by region
+            if self.region_drill_down and response.meta.get(
+                    'page') == 1 and page_count >= self.further_threshold:
+                region_requests = list(self.region_requests(response))
+                if region_requests:
+                    for request in region_requests:
+                        yield request
+                    self.finish_page(response)
+                    return
+
             # process the current page
-            for weibo in self.parse_weibo(response):
+            for weibo in self.parse_weibo(response, result.get('cards')):
                 # check software dependency
                 self.check_environment()
 
                 # yield weibo
+                if self.page_items is not None:
+                    self.page_items[response] += 1
                 yield weibo
 
             # find next page url
-            next_url = response.xpath(
-                '//a[@class="next"]/@href').extract_first()
+            next_url = result['next_url']
 
             # if next url exists
             if next_url:
@@ -218,286 +481,132 @@ class SearchSpider(scrapy.Spider):
                 next_url = self.base_url + next_url
 
                 # make request to next url and recursively call parse method
+                meta = self.window_meta(response)
+                meta['page'] = response.meta.get('page', 1) + 1
+                self.track_page(meta, next_url)
                 yield scrapy.Request(url=next_url,
-                                     callback=self.parse,
-                                     meta={'keyword': keyword})
-
-    def get_article_url(self, selector):
-        """获取微博头条文章url"""
-        article_url = ''
-        text = selector.xpath('string(.)').extract_first().replace(
-            '\u200b', '').replace('\ue627', '').replace('\n',
-                                                        '').replace(' ', '')
-        if text.startswith('发布了头条文章'):
-            urls = selector.xpath('.//a')
-            for url in urls:
-                if url.xpath(
-                        'i[@class="wbicon"]/text()').extract_first() == 'O':
-                    if url.xpath('@href').extract_first() and url.xpath(
-                            '@href').extract_first().startswith('http://t.cn'):
-                        article_url = url.xpath('@href').extract_first()
-                    break
-        return article_url
-
-    def get_location(self, selector):
-        """获取微博发布位置"""
-        a_list = selector.xpath('.//a')
-        location = ''
-        for a in a_list:
-            if a.xpath('./i[@class="wbicon"]') and a.xpath(
-                    './i[@class="wbicon"]/text()').extract_first() == '2':
-                location = a.xpath('string(.)').extract_first()[1:]
-                break
-        return location
-
-    def get_at_users(self, selector):
-        """获取微博中@的用户昵称"""
-        a_list = selector.xpath('.//a')
-        at_users = ''
-        at_list = []
-        for a in a_list:
-            if len(unquote(a.xpath('@href').extract_first())) > 14 and len(
-                    a.xpath('string(.)').extract_first()) > 1:
-                if unquote(a.xpath('@href').extract_first())[14:] == a.xpath(
-                        'string(.)').extract_first()[1:]:
-                    at_user = a.xpath('string(.)').extract_first()[1:]
-                    if at_user not in at_list:
-                        at_list.append(at_user)
-        if at_list:
-            at_users = ','.join(at_list)
-        return at_users
-
-    def get_topics(self, selector):
-        """获取参与的微博话题"""
-        a_list = selector.xpath('.//a')
-        topics = ''
-        topic_list = []
-        for a in a_list:
-            text = a.xpath('string(.)').extract_first()
-            if len(text) > 2 and text[0] == '#' and text[-1] == '#':
-                if text[1:-1] not in topic_list:
-                    topic_list.append(text[1:-1])
-        if topic_list:
-            topics = ','.join(topic_list)
-        return topics
-
-    def date_processing(self):
-        """ Return the start time and end time for each hour, e.g. 2020-09-01-13 and 2020-09-01-14"""
-
-        # start time e.g. 2020-09-01-13:00
-        start_str = self.start_date_2.strftime('%Y-%m-%d-X%H').replace(
-            'X0', 'X').replace('X', '')
-
-        # update to obtain end time e.g. 2020-09-01-14:00
-        self.start_date_2 = self.start_date_2 + timedelta(hours=1)
-
-        # format end time
-        end_str = self.start_date_2.strftime('%Y-%m-%d-X%H').replace(
-            'X0', 'X').replace('X', '')
-
-        return start_str, end_str
-
-    def parse_weibo(self, response):
-        """解析网页中的微博信息"""
+                                     callback=self.page_callback(),
+                                     meta=meta)
+
+            self.finish_page(response)
+
+    def page_parsed(self, response, result):
+        """Send the overview of a parsed result page to extensions such as WindowStats"""
+        crawler = getattr(self, 'crawler', None)
+        if crawler:
+            crawler.signals.send_catch_log(page_parsed,
+                                           response=response,
+                                           result=result,
+                                           spider=self)
+
+    def flush_items(self):
+        """Ask the pipelines to write their buffered items before the frontier saves finished pages,
+        return a Deferred fired once every pipeline is done"""
+        crawler = getattr(self, 'crawler', None)
+        if crawler:
+            return crawler.signals.send_catch_log_deferred(checkpoint,
+                                                           spider=self)
+
+    def window_meta(self, response):
+        """Copy the search window information of a response to the meta of a follow-up request"""
+        return {
+            key: response.meta[key]
+            for key in ('base_url', 'keyword', 'province', 'city',
+                        'start_time', 'end_time', 'unit') if key in response.meta
+        }
+
+    def window_request(self, meta, start_time, end_time, timescope=None):
+        """Build the first-page request of the search described by meta for the given window,
+        timescope is the precomputed value from the window table"""
+        meta['start_time'] = start_time
+        meta['end_time'] = end_time
+        meta['page'] = 1
+        if timescope is None:
+            timescope = util.format_timescope(start_time, end_time)
+        url = meta['base_url'] + self.search_filters + '&timescope=' + timescope
+        self.track_page(meta, url)
+        return scrapy.Request(url=url, callback=self.page_callback(), meta=meta)
+
+    def region_requests(self, response):
+        """Split the search behind response into province searches (national search)
+        or city searches (province search) over the same window"""
+        keyword = response.meta.get('keyword')
+        start_time = response.meta['start_time']
+        end_time = response.meta['end_time']
+        province = response.meta.get('province')
+
+        # national search, e.g. region=custom:34:1000 is the whole of 安徽
+        if not province:
+            for region in util.get_regions(None).values():
+                meta = self.window_meta(response)
+                meta['base_url'] = self.region_base_url(keyword, region['code'])
+                meta['province'] = region
+                yield self.window_request(meta, start_time, end_time)
+
+        # province search, e.g. region=custom:34:1 is 合肥 in 安徽
+        elif not response.meta.get('city'):
+            for city, code in province['city'].items():
+                # 1000 already stands for the whole province
+                if code == 1000:
+                    continue
+                meta = self.window_meta(response)
+                meta['base_url'] = self.region_base_url(
+                    keyword, province['code'], code)
+                meta['city'] = city
+                yield self.window_request(meta, start_time, end_time)
+
+    def page_callback(self):
+        """Return the callback for result pages, parse_offloaded when pages are parsed in worker processes"""
+        return self.parse_offloaded if self.parse_processes else self.parse
+
+    def offload_page(self, response):
+        """Parse the page behind response with parser.parse_text in the process pool, return a Deferred"""
+        if self.parse_pool is None:
+            self.parse_pool = ProcessPoolExecutor(self.parse_processes)
+        d = defer.Deferred()
+
+        def fire(future):
+            if future.exception() is not None:
+                d.errback(Failure(future.exception()))
+            else:
+                d.callback(future.result())
+
+        future = self.parse_pool.submit(parser.parse_text, response.text)
+        future.add_done_callback(
+            lambda future: reactor.callFromThread(fire, future))
+        return d
+
+    async def parse_offloaded(self, response):
+        """Same as parse, but the HTML is parsed in a worker process so that the reactor thread
+        only builds items and requests from plain dicts"""
+        try:
+            result = await maybe_deferred_to_future(
+                self.offload_page(response))
+        except TypeError:
+            raise self.layout_error()
+        return list(self.parse(response, result))
+
+    def layout_error(self):
+        """Log that the count buttons could not be parsed and return the exception closing the spider"""
+        logger.error(
+            "无法解析转发按钮，可能是 1) 网页布局有改动 2) cookie无效或已过期。\n"
+            "请在 https://github.com/dataabc/weibo-search 查看文档，以解决问题，"
+        )
+        return CloseSpider()
+
+    def parse_weibo(self, response, cards=None):
+        """解析网页中的微博信息，cards为子进程中已解析出的微博卡片"""
         keyword = response.meta.get('keyword')
 
-        # for each post on the page
-        for sel in response.xpath("//div[@class='card-wrap']"):
-            # enter into more detail
-            info = sel.xpath(
-                "div[@class='card']/div[@class='card-feed']/div[@class='content']/div[@class='info']"
-            )
-
-            # extract different info
-            if info:
-                weibo = WeiboItem()
-                weibo['id'] = sel.xpath('@mid').extract_first()
-                try:
-                    weibo['bid'] = sel.xpath(
-                        './/p[@class="from"]/a[1]/@href').extract_first(
-                    ).split('/')[-1].split('?')[0]
-                except:
-                    weibo['bid'] = sel.xpath(
-                        './/div[@class="from"]/a[1]/@href').extract_first(
-                    ).split('/')[-1].split('?')[0]
-                weibo['user_id'] = info[0].xpath(
-                    'div[2]/a/@href').extract_first().split('?')[0].split(
-                    '/')[-1]
-                weibo['screen_name'] = info[0].xpath(
-                    'div[2]/a/@nick-name').extract_first()
-                txt_sel = sel.xpath('.//p[@class="txt"]')[0]
-                retweet_sel = sel.xpath('.//div[@class="card-comment"]')
-                retweet_txt_sel = ''
-                if retweet_sel and retweet_sel[0].xpath('.//p[@class="txt"]'):
-                    retweet_txt_sel = retweet_sel[0].xpath(
-                        './/p[@class="txt"]')[0]
-                content_full = sel.xpath(
-                    './/p[@node-type="feed_list_content_full"]')
-                is_long_weibo = False
-                is_long_retweet = False
-                if content_full:
-                    if not retweet_sel:
-                        txt_sel = content_full[0]
-                        is_long_weibo = True
-                    elif len(content_full) == 2:
-                        txt_sel = content_full[0]
-                        retweet_txt_sel = content_full[1]
-                        is_long_weibo = True
-                        is_long_retweet = True
-                    elif retweet_sel[0].xpath(
-                            './/p[@node-type="feed_list_content_full"]'):
-                        retweet_txt_sel = retweet_sel[0].xpath(
-                            './/p[@node-type="feed_list_content_full"]')[0]
-                        is_long_retweet = True
-                    else:
-                        txt_sel = content_full[0]
-                        is_long_weibo = True
-                weibo['text'] = txt_sel.xpath(
-                    'string(.)').extract_first().replace('\u200b', '').replace(
-                    '\ue627', '')
-                weibo['article_url'] = self.get_article_url(txt_sel)
-                weibo['location'] = self.get_location(txt_sel)
-                if weibo['location']:
-                    weibo['text'] = weibo['text'].replace(
-                        '2' + weibo['location'], '')
-                weibo['text'] = weibo['text'][2:].replace(' ', '')
-                if is_long_weibo:
-                    weibo['text'] = weibo['text'][:-4]
-                weibo['at_users'] = self.get_at_users(txt_sel)
-                weibo['topics'] = self.get_topics(txt_sel)
-                reposts_count = sel.xpath(
-                    './/a[@action-type="feed_list_forward"]/text()').extract()
-                reposts_count = "".join(reposts_count)
-                try:
-                    reposts_count = re.findall(r'\d+.*', reposts_count)
-                except TypeError:
-                    logger.error(
-                        "无法解析转发按钮，可能是 1) 网页布局有改动 2) cookie无效或已过期。\n"
-                        "请在 https://github.com/dataabc/weibo-search 查看文档，以解决问题，"
-                    )
-                    raise CloseSpider()
-                weibo['reposts_count'] = reposts_count[
-                    0] if reposts_count else '0'
-                comments_count = sel.xpath(
-                    './/a[@action-type="feed_list_comment"]/text()'
-                ).extract_first()
-                try:
-                    comments_count = re.findall(r'\d+.*', comments_count)
-                except:
-                    comments_count = 0
-                weibo['comments_count'] = comments_count[
-                    0] if comments_count else '0'
-                attitudes_count = sel.xpath(
-                    '(.//span[@class="woo-like-count"])[last()]/text()').extract_first()
-                attitudes_count = re.findall(r'\d+.*', attitudes_count)
-                weibo['attitudes_count'] = attitudes_count[
-                    0] if attitudes_count else '0'
-                try:
-                    created_at = sel.xpath(
-                        './/p[@class="from"]/a[1]/text()').extract_first(
-                    ).replace(' ', '').replace('\n', '').split('前')[0]
-                except:
-                    created_at = sel.xpath(
-                        './/div[@class="from"]/a[1]/text()').extract_first(
-                    ).replace(' ', '').replace('\n', '').split('前')[0]
-                weibo['created_at'] = util.standardize_date(created_at)
-                try:
-                    source = sel.xpath('.//p[@class="from"]/a[2]/text()'
-                                       ).extract_first()
-                except:
-                    source = sel.xpath('.//div[@class="from"]/a[2]/text()'
-                                       ).extract_first()
-                weibo['source'] = source if source else ''
-                pics = ''
-                is_exist_pic = sel.xpath(
-                    './/div[@class="media media-piclist"]')
-                if is_exist_pic:
-                    pics = is_exist_pic[0].xpath('ul[1]/li/img/@src').extract()
-                    pics = [pic[8:] for pic in pics]
-                    pics = [
-                        re.sub(r'/.*?/', '/large/', pic, 1) for pic in pics
-                    ]
-                    pics = ['https://' + pic for pic in pics]
-                video_url = ''
-                is_exist_video = sel.xpath(
-                    './/div[@class="thumbnail"]//video-player').extract_first()
-                if is_exist_video:
-                    video_url = re.findall(r'src:\'(.*?)\'', is_exist_video)[0]
-                    video_url = video_url.replace('&amp;', '&')
-                    video_url = 'http:' + video_url
-                if not retweet_sel:
-                    weibo['pics'] = pics
-                    weibo['video_url'] = video_url
-                else:
-                    weibo['pics'] = ''
-                    weibo['video_url'] = ''
-                weibo['retweet_id'] = ''
-                if retweet_sel and retweet_sel[0].xpath(
-                        './/div[@node-type="feed_list_forwardContent"]/a[1]'):
-                    retweet = WeiboItem()
-                    retweet['id'] = retweet_sel[0].xpath(
-                        './/a[@action-type="feed_list_like"]/@action-data'
-                    ).extract_first()[4:]
-                    try:
-                        retweet['bid'] = retweet_sel[0].xpath(
-                            './/p[@class="from"]/a/@href').extract_first().split(
-                            '/')[-1].split('?')[0]
-                    except:
-                        retweet['bid'] = retweet_sel[0].xpath(
-                            './/div[@class="from"]/a/@href').extract_first().split(
-                            '/')[-1].split('?')[0]
-                    info = retweet_sel[0].xpath(
-                        './/div[@node-type="feed_list_forwardContent"]/a[1]'
-                    )[0]
-                    retweet['user_id'] = info.xpath(
-                        '@href').extract_first().split('/')[-1]
-                    retweet['screen_name'] = info.xpath(
-                        '@nick-name').extract_first()
-                    retweet['text'] = retweet_txt_sel.xpath(
-                        'string(.)').extract_first().replace('\u200b',
-                                                             '').replace(
-                        '\ue627', '')
-                    retweet['article_url'] = self.get_article_url(
-                        retweet_txt_sel)
-                    retweet['location'] = self.get_location(retweet_txt_sel)
-                    if retweet['location']:
-                        retweet['text'] = retweet['text'].replace(
-                            '2' + retweet['location'], '')
-                    retweet['text'] = retweet['text'][2:].replace(' ', '')
-                    if is_long_retweet:
-                        retweet['text'] = retweet['text'][:-4]
-                    retweet['at_users'] = self.get_at_users(retweet_txt_sel)
-                    retweet['topics'] = self.get_topics(retweet_txt_sel)
-                    reposts_count = retweet_sel[0].xpath(
-                        './/ul[@class="act s-fr"]/li[1]/a[1]/text()'
-                    ).extract_first()
-                    reposts_count = re.findall(r'\d+.*', reposts_count)
-                    retweet['reposts_count'] = reposts_count[
-                        0] if reposts_count else '0'
-                    comments_count = retweet_sel[0].xpath(
-                        './/ul[@class="act s-fr"]/li[2]/a[1]/text()'
-                    ).extract_first()
-                    comments_count = re.findall(r'\d+.*', comments_count)
-                    retweet['comments_count'] = comments_count[
-                        0] if comments_count else '0'
-                    attitudes_count = retweet_sel[0].xpath(
-                        './/a[@class="woo-box-flex woo-box-alignCenter woo-box-justifyCenter"]//span[@class="woo-like-count"]/text()'
-                    ).extract_first()
-                    attitudes_count = re.findall(r'\d+.*', attitudes_count)
-                    retweet['attitudes_count'] = attitudes_count[
-                        0] if attitudes_count else '0'
-                    created_at = retweet_sel[0].xpath(
-                        './/p[@class="from"]/a[1]/text()').extract_first(
-                    ).replace(' ', '').replace('\n', '').split('前')[0]
-                    retweet['created_at'] = util.standardize_date(created_at)
-                    source = retweet_sel[0].xpath(
-                        './/p[@class="from"]/a[2]/text()').extract_first()
-                    retweet['source'] = source if source else ''
-                    retweet['pics'] = pics
-                    retweet['video_url'] = video_url
-                    retweet['retweet_id'] = ''
-                    yield {'weibo': retweet, 'keyword': keyword}
-                    weibo['retweet_id'] = retweet['id']
+        # each card is parsed in a single pass by precompiled XPaths on the raw lxml tree,
+        # a missing count button means the layout changed or the cookie is no longer valid
+        if cards is None:
+            cards = parser.parse_cards(response.selector.root)
+        try:
+            for weibo, retweet in cards:
+                if retweet:
+                    yield WeiboItem.from_dict(retweet, keyword)
+                weibo = WeiboItem.from_dict(weibo, keyword)
                 self.counting = self.counting + 1
 
                 # print progress for every 500 posts
@@ -506,10 +615,29 @@ class SearchSpider(scrapy.Spider):
                     logger.info(weibo)
                     print(weibo)
                     print('work in progress. posts count: ' + str(self.counting))
-                yield {'weibo': weibo, 'keyword': keyword}
+                yield weibo
+        except TypeError:
+            raise self.layout_error()
 
     def close(self, reason):
         """Record program duration"""
+        if self.high_water_marks:
+            # a keyword's mark only moves when the run finished and none of its pages failed
+            if reason == 'finished':
+                for keyword, (_, end_time) in self.search_ranges.items():
+                    if self.outstanding[keyword] <= 0:
+                        self.high_water_marks.set(keyword,
+                                                  self.search_filters,
+                                                  end_time)
+            self.high_water_marks.close()
+        if self.frontier:
+            self.frontier.close()
+        if self.empty_windows:
+            self.empty_windows.close()
+        if self.work_queue:
+            self.work_queue.close()
+        if self.parse_pool:
+            self.parse_pool.shutdown()
         start_time = self.crawler.stats.get_value('start_time')
         finish_time = self.crawler.stats.get_value('finish_time')
         print("Total run time: ", finish_time - start_time, " (hour:min:sec) ")
@@ -0,0 +1,230 @@
+import hashlib
+import math
+import os
+import pickle
+import sqlite3
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+def make_dirs(file_path):
+    """创建文件所在的文件夹"""
+    base_dir = os.path.dirname(file_path)
+    if base_dir and not os.path.isdir(base_dir):
+        os.makedirs(base_dir)
+
+
+class IdSet(object):
+    """以Python集合保存微博id，不持久化"""
+
+    def __init__(self):
+        self.ids = set()
+
+    def add(self, weibo_id):
+        """添加微博id，若该id此前未出现过则返回True"""
+        if weibo_id in self.ids:
+            return False
+        self.ids.add(weibo_id)
+        return True
+
+    def close(self):
+        pass
+
+
+class IntIdSet(object):
+    """把数字形式的微博id压缩存储在有序的64位整数数组中，每个id约占8字节，新id先进入缓冲集合，缓冲区满后合并进数组。
+    平时内存约为IdSet的八分之一，合并时需同时保存新旧两个数组，峰值约为IdSet的三分之一；代价是每次添加都要在数组中二分查找，
+    速度约为IdSet的十分之一（300万个id约需14秒），适合id数量大到集合放不进内存的运行。若指定file_path，结束时把数组写入文件，下次运行时读取"""
+
+    def __init__(self, file_path=None, min_buffer_size=65536):
+        self.file_path = file_path
+        self.min_buffer_size = min_buffer_size
+        self.ids = array('Q')
+        self.buffer = set()
+        # 非数字形式的id无法压缩，单独保存
+        self.other_ids = set()
+        if file_path and os.path.isfile(file_path):
+            with open(file_path, 'rb') as f:
+                self.ids.frombytes(f.read())
+
+    def __contains__(self, weibo_id):
+        if weibo_id in self.buffer:
+            return True
+        i = bisect_left(self.ids, weibo_id)
+        return i < len(self.ids) and self.ids[i] == weibo_id
+
+    def add(self, weibo_id):
+        """添加微博id，若该id此前未出现过则返回True"""
+        try:
+            weibo_id = int(weibo_id)
+            if not 0 <= weibo_id < 1 << 64:
+                raise ValueError
+        except (TypeError, ValueError):
+            if weibo_id in self.other_ids:
+                return False
+            self.other_ids.add(weibo_id)
+            return True
+        if weibo_id in self:
+            return False
+        self.buffer.add(weibo_id)
+        # 缓冲区随数组增大，使合并的总代价保持在O(n log n)
+        if len(self.buffer) >= max(self.min_buffer_size, len(self.ids) // 8):
+            self.flush()
+        return True
+
+    def flush(self, chunk_size=65536):
+        """把缓冲集合合并进有序数组，原数组按chunk_size个id分块，每块与落在其范围内的新id排序后写入预先分配的新数组，
+        合并时内存峰值约为新旧两个数组，不会把整个数组转换为Python整数列表"""
+        if self.buffer:
+            new_ids = sorted(self.buffer)
+            merged = array('Q', [0]) * (len(self.ids) + len(new_ids))
+            out = j = 0
+            for start in range(0, len(self.ids), chunk_size):
+                chunk = self.ids[start:start + chunk_size].tolist()
+                k = bisect_right(new_ids, chunk[-1], j)
+                chunk.extend(new_ids[j:k])
+                chunk.sort()
+                merged[out:out + len(chunk)] = array('Q', chunk)
+                out += len(chunk)
+                j = k
+            merged[out:] = array('Q', new_ids[j:])
+            self.ids = merged
+            self.buffer = set()
+
+    def close(self):
+        if self.file_path:
+            self.flush()
+            make_dirs(self.file_path)
+            with open(self.file_path, 'wb') as f:
+                self.ids.tofile(f)
+
+
+class BloomFilter(object):
+    """位数组实现的布隆过滤器，最多容纳capacity个元素，误判率约为error_rate"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.bit_count = int(
+            math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+        self.hash_count = max(
+            1, int(round(self.bit_count / capacity * math.log(2))))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        """使用双重哈希由一次blake2b摘要得到hash_count个位置"""
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bit_count
+                for i in range(self.hash_count)]
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self.positions(key))
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+class ScalableBloomFilter(object):
+    """可扩展的布隆过滤器，当前过滤器装满后新建一个容量加倍、误判率减半的过滤器，总误判率不超过error_rate。
+    存在极小概率把新微博误判为重复，若指定file_path，结束时把过滤器写入文件，下次运行时读取"""
+
+    def __init__(self,
+                 file_path=None,
+                 initial_capacity=1000000,
+                 error_rate=0.0001):
+        self.file_path = file_path
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.filters = []
+        if file_path and os.path.isfile(file_path):
+            with open(file_path, 'rb') as f:
+                self.filters = pickle.load(f)
+
+    def __contains__(self, weibo_id):
+        return any(weibo_id in f for f in self.filters)
+
+    def add(self, weibo_id):
+        """添加微博id，若该id此前未出现过则返回True"""
+        weibo_id = str(weibo_id)
+        if weibo_id in self:
+            return False
+        if not self.filters or self.filters[-1].count >= self.filters[
+                -1].capacity:
+            # 各过滤器的误判率为error_rate/2, error_rate/4, ...，总和不超过error_rate
+            self.filters.append(
+                BloomFilter(self.initial_capacity * 2**len(self.filters),
+                            self.error_rate / 2**(len(self.filters) + 1)))
+        self.filters[-1].add(weibo_id)
+        return True
+
+    def close(self):
+        if self.file_path:
+            make_dirs(self.file_path)
+            with open(self.file_path, 'wb') as f:
+                pickle.dump(self.filters, f, pickle.HIGHEST_PROTOCOL)
+
+
+class SqliteIdSet(object):
+    """把微博id保存在SQLite数据库中，内存占用与id数量无关，并可在多次运行间保留"""
+
+    def __init__(self, file_path, commit_interval=1000):
+        make_dirs(file_path)
+        self.db = sqlite3.connect(file_path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY) WITHOUT ROWID'
+        )
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+
+    def add(self, weibo_id):
+        """添加微博id，若该id此前未出现过则返回True"""
+        cursor = self.db.execute('INSERT OR IGNORE INTO ids (id) VALUES (?)',
+                                 (str(weibo_id), ))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_interval:
+            self.db.commit()
+            self.uncommitted = 0
+        return cursor.rowcount == 1
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class RedisIdSet(object):
+    """把微博id保存在Redis集合中，可供多台机器上的爬虫进程共用"""
+
+    def __init__(self, url, key='weibo:ids'):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.key = key
+
+    def add(self, weibo_id):
+        """添加微博id，若该id此前未出现过则返回True"""
+        return self.redis.sadd(self.key, str(weibo_id)) == 1
+
+    def close(self):
+        self.redis.close()
+
+
+def get_id_set(backend, file_path=None, bloom_capacity=1000000,
+               bloom_error_rate=0.0001, redis_url=None, shared=False):
+    """根据去重方式返回保存微博id的对象，shared为True时多个进程共用同一个SQLite文件，每次写入立即提交"""
+    if backend == 'redis':
+        return RedisIdSet(redis_url or 'redis://localhost:6379/0')
+    elif backend == 'int':
+        return IntIdSet(file_path)
+    elif backend == 'bloom':
+        return ScalableBloomFilter(file_path, bloom_capacity,
+                                   bloom_error_rate)
+    elif backend == 'sqlite':
+        return SqliteIdSet(file_path or 'crawls/ids.db',
+                           1 if shared else 1000)
+    return IdSet()
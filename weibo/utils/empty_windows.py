@@ -0,0 +1,59 @@
+import sqlite3
+import time
+
+from weibo.utils.dedup import make_dirs
+
+
+class EmptyWindowCache(object):
+    """记录没有搜索结果的时间窗口，以(关键词, 地区, 筛选条件, 时间范围)为键，供之后的运行跳过。
+    结束时间距检查时间不足ttl秒的窗口可能还会有新微博，其记录在ttl秒后失效，ttl为None时记录永不失效"""
+
+    def __init__(self, file_path, ttl=None, commit_interval=500):
+        make_dirs(file_path)
+        self.db = sqlite3.connect(file_path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS empty_windows (
+            keyword TEXT NOT NULL,
+            region TEXT NOT NULL,
+            filters TEXT NOT NULL,
+            timescope TEXT NOT NULL,
+            checked_at REAL NOT NULL,
+            expires_at REAL,
+            PRIMARY KEY (keyword, region, filters, timescope)
+            )""")
+        self.ttl = ttl
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        self.loaded = {}
+
+    def load(self, filters):
+        """读取某个筛选条件下全部未失效的空窗口，返回{(关键词, 地区, 时间范围)}"""
+        if filters not in self.loaded:
+            self.loaded[filters] = set(
+                self.db.execute(
+                    'SELECT keyword, region, timescope FROM empty_windows WHERE filters = ? AND (expires_at IS NULL OR expires_at > ?)',
+                    (filters, time.time())))
+        return self.loaded[filters]
+
+    def contains(self, keyword, region, filters, timescope):
+        """判断某个窗口是否已知没有结果"""
+        return (keyword, region, timescope) in self.load(filters)
+
+    def add(self, keyword, region, filters, timescope, end_time):
+        """记录一个没有结果的窗口，end_time为窗口的结束时间"""
+        now = time.time()
+        expires_at = None
+        if self.ttl is not None and end_time.timestamp() > now - self.ttl:
+            expires_at = now + self.ttl
+        self.db.execute(
+            'INSERT OR REPLACE INTO empty_windows VALUES (?, ?, ?, ?, ?, ?)',
+            (keyword, region, filters, timescope, now, expires_at))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_interval:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
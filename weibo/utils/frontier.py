@@ -0,0 +1,128 @@
+import os
+import sqlite3
+from datetime import datetime
+
+from twisted.internet import defer
+
+
+class Frontier(object):
+    """记录搜索进度的SQLite数据库，每条记录以(关键词, 地区, 时间范围, 页码)为键，标记该页是否已完成。
+    完成的页面先保存在内存中，每commit_interval页调用一次flush（让pipeline写入缓存的结果，可返回Deferred），
+    写入完成后才把这些页面标记为已完成，程序中断时结果未写入的页面在恢复时会重新获取"""
+
+    def __init__(self, file_path, commit_interval=500, flush=None):
+        base_dir = os.path.dirname(file_path)
+        if base_dir and not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+        self.db = sqlite3.connect(file_path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS frontier (
+            keyword TEXT NOT NULL,
+            region TEXT NOT NULL,
+            timescope TEXT NOT NULL,
+            page INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (keyword, region, timescope, page)
+            )""")
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        self.flush = flush
+        self.finished = []
+
+    def commit(self, force=False):
+        """每累计commit_interval次写入提交一次"""
+        self.uncommitted += 1
+        if force or self.uncommitted >= self.commit_interval:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def clear(self):
+        """清空进度，用于不恢复进度的全新运行"""
+        self.db.execute('DELETE FROM frontier')
+        self.commit(force=True)
+
+    def add(self, keyword, region, timescope, page, url):
+        """记录一个待完成的页面，已存在的记录保持不变"""
+        self.db.execute(
+            'INSERT OR IGNORE INTO frontier (keyword, region, timescope, page, url) VALUES (?, ?, ?, ?, ?)',
+            (keyword, region, timescope, page, url))
+        self.commit()
+
+    def finish(self, keyword, region, timescope, page):
+        """记录一个已完成的页面，在下一次checkpoint时保存"""
+        self.finished.append((keyword, region, timescope, page))
+        if len(self.finished) >= self.commit_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """先调用flush写入缓存的结果，完成后再保存此前完成的页面，返回Deferred"""
+        finished, self.finished = self.finished, []
+        d = defer.maybeDeferred(self.flush) if self.flush else defer.succeed(
+            None)
+        d.addCallback(lambda _: self.save(finished))
+        return d
+
+    def save(self, finished):
+        """把页面标记为已完成并提交，数据库已关闭时不再保存，这些页面在恢复时会重新获取"""
+        if self.db is None:
+            return
+        self.db.executemany(
+            'UPDATE frontier SET done = 1 WHERE keyword = ? AND region = ? AND timescope = ? AND page = ?',
+            finished)
+        self.commit(force=True)
+
+    def contains(self, keyword, region, timescope):
+        """判断某个搜索窗口是否已被记录，无论其是否完成"""
+        cursor = self.db.execute(
+            'SELECT 1 FROM frontier WHERE keyword = ? AND region = ? AND timescope = ? LIMIT 1',
+            (keyword, region, timescope))
+        return cursor.fetchone() is not None
+
+    def pending(self):
+        """返回全部未完成页面的(关键词, 地区, 时间范围, 页码, url)"""
+        return self.db.execute(
+            'SELECT keyword, region, timescope, page, url FROM frontier WHERE done = 0'
+        ).fetchall()
+
+    def close(self):
+        """在pipeline关闭后调用，此时结果均已写入，直接保存剩余的完成页面"""
+        self.save(self.finished)
+        self.finished = []
+        self.db.close()
+        self.db = None
+
+
+class HighWaterMarks(object):
+    """记录每个关键词在某个筛选条件下已完整搜索到的时间，供增量模式下次运行从该时间继续"""
+
+    def __init__(self, file_path):
+        base_dir = os.path.dirname(file_path)
+        if base_dir and not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+        self.db = sqlite3.connect(file_path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS high_water_marks (
+            keyword TEXT NOT NULL,
+            filters TEXT NOT NULL,
+            mark TEXT NOT NULL,
+            PRIMARY KEY (keyword, filters)
+            )""")
+
+    def get(self, keyword, filters):
+        """返回关键词已完整搜索到的时间，没有记录时返回None"""
+        row = self.db.execute(
+            'SELECT mark FROM high_water_marks WHERE keyword = ? AND filters = ?',
+            (keyword, filters)).fetchone()
+        return datetime.strptime(row[0], '%Y-%m-%d %H:%M') if row else None
+
+    def set(self, keyword, filters, mark):
+        """更新关键词已完整搜索到的时间"""
+        self.db.execute(
+            'INSERT OR REPLACE INTO high_water_marks (keyword, filters, mark) VALUES (?, ?, ?)',
+            (keyword, filters, mark.strftime('%Y-%m-%d %H:%M')))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
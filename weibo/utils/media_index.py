@@ -0,0 +1,37 @@
+import sqlite3
+
+from weibo.utils.dedup import make_dirs
+
+
+class MediaIndex(object):
+    """记录已下载的图片和视频url及其保存路径和sha1，在多次运行和多个关键词间共用，已记录的url不再下载"""
+
+    def __init__(self, file_path, commit_interval=100):
+        make_dirs(file_path)
+        self.db = sqlite3.connect(file_path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS media (
+            url TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            sha1 TEXT NOT NULL
+            )""")
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+
+    def get(self, url):
+        """返回url对应的(保存路径, sha1)，没有记录时返回None"""
+        return self.db.execute('SELECT path, sha1 FROM media WHERE url = ?',
+                               (url, )).fetchone()
+
+    def add(self, url, path, sha1):
+        self.db.execute('INSERT OR REPLACE INTO media VALUES (?, ?, ?)',
+                        (url, path, sha1))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_interval:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
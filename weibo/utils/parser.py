@@ -0,0 +1,274 @@
+import re
+from urllib.parse import unquote
+
+from lxml import etree
+from parsel import Selector
+
+from weibo.utils.util import standardize_date
+
+
+def xpath(path):
+    """预编译XPath，结果为普通字符串，不引用文档树"""
+    return etree.XPath(path, smart_strings=False)
+
+
+# 预编译的XPath，每张卡片只在自身子树上执行
+EMPTY = xpath('//div[@class="card card-no-result s-pt20b40"]')
+PAGES = xpath('//ul[@class="s-scroll"]/li')
+PERIOD = xpath('//span[@class="ctips"]//text()')
+NEXT = xpath('//a[@class="next"]/@href')
+CARDS = xpath("//div[@class='card-wrap']")
+INFO = xpath(
+    "div[@class='card']/div[@class='card-feed']/div[@class='content']/div[@class='info']"
+)
+BID_P = xpath('.//p[@class="from"]/a[1]/@href')
+BID_DIV = xpath('.//div[@class="from"]/a[1]/@href')
+USER_HREF = xpath('div[2]/a/@href')
+NICK_NAME = xpath('div[2]/a/@nick-name')
+TXT = xpath('.//p[@class="txt"]')
+RETWEET = xpath('.//div[@class="card-comment"]')
+CONTENT_FULL = xpath('.//p[@node-type="feed_list_content_full"]')
+STRING = xpath('string(.)')
+REPOSTS = xpath('.//a[@action-type="feed_list_forward"]/text()')
+COMMENTS = xpath('.//a[@action-type="feed_list_comment"]/text()')
+ATTITUDES = xpath('(.//span[@class="woo-like-count"])[last()]/text()')
+CREATED_AT_P = xpath('.//p[@class="from"]/a[1]/text()')
+CREATED_AT_DIV = xpath('.//div[@class="from"]/a[1]/text()')
+SOURCE_P = xpath('.//p[@class="from"]/a[2]/text()')
+PICLIST = xpath('.//div[@class="media media-piclist"]')
+PICS = xpath('ul[1]/li/img/@src')
+VIDEO = xpath('.//div[@class="thumbnail"]//video-player')
+RETWEET_INFO = xpath('.//div[@node-type="feed_list_forwardContent"]/a[1]')
+RETWEET_ID = xpath('.//a[@action-type="feed_list_like"]/@action-data')
+RETWEET_BID_P = xpath('.//p[@class="from"]/a/@href')
+RETWEET_BID_DIV = xpath('.//div[@class="from"]/a/@href')
+RETWEET_REPOSTS = xpath('.//ul[@class="act s-fr"]/li[1]/a[1]/text()')
+RETWEET_COMMENTS = xpath('.//ul[@class="act s-fr"]/li[2]/a[1]/text()')
+RETWEET_ATTITUDES = xpath(
+    './/a[@class="woo-box-flex woo-box-alignCenter woo-box-justifyCenter"]//span[@class="woo-like-count"]/text()'
+)
+
+COUNT = re.compile(r'\d+.*')
+VIDEO_SRC = re.compile(r'src:\'(.*?)\'')
+PIC_SIZE = re.compile(r'/.*?/')
+
+
+def first(values):
+    """返回XPath结果中的第一个值，没有结果时返回None"""
+    return values[0] if values else None
+
+
+def get_count(text):
+    """从按钮文字中提取数量，如“转发 12”中的12，没有数量时返回'0'"""
+    count = COUNT.findall(text)
+    return count[0] if count else '0'
+
+
+def wbicon_text(a):
+    """返回链接中第一个class为wbicon的i元素的第一段文字，即a.xpath('i[@class="wbicon"]/text()')的第一个结果"""
+    for i in a:
+        if i.tag == 'i' and i.get('class') == 'wbicon':
+            if i.text is not None:
+                return i.text
+            for child in i:
+                if child.tail is not None:
+                    return child.tail
+    return None
+
+
+def parse_txt(txt):
+    """遍历一次正文中的全部链接，返回(头条文章url, 发布位置, @用户, 话题)"""
+    article_url = ''
+    location = ''
+    at_list = []
+    topic_list = []
+    is_article = STRING(txt).replace('\u200b', '').replace(
+        '\ue627', '').replace('\n', '').replace(' ', '').startswith('发布了头条文章')
+    find_article = is_article
+    find_location = True
+    for a in txt.iter('a'):
+        href = a.get('href')
+        text = STRING(a)
+        icon = wbicon_text(a)
+
+        # 头条文章url，只看第一个图标为O的链接
+        if find_article and icon == 'O':
+            if href and href.startswith('http://t.cn'):
+                article_url = href
+            find_article = False
+
+        # 发布位置，即第一个图标为2的链接
+        if find_location and icon == '2':
+            location = text[1:]
+            find_location = False
+
+        # @用户，链接形如//weibo.com/n/用户昵称
+        if href is not None:
+            user = unquote(href)
+            if len(user) > 14 and len(text) > 1 and user[14:] == text[1:]:
+                if text[1:] not in at_list:
+                    at_list.append(text[1:])
+
+        # 话题，即两个#中的内容
+        if len(text) > 2 and text[0] == '#' and text[-1] == '#':
+            if text[1:-1] not in topic_list:
+                topic_list.append(text[1:-1])
+    return article_url, location, ','.join(at_list), ','.join(topic_list)
+
+
+def get_text(txt, location, is_long):
+    """获取去除发布位置、空格和“收起全文”的微博正文"""
+    text = STRING(txt).replace('\u200b', '').replace('\ue627', '')
+    if location:
+        text = text.replace('2' + location, '')
+    text = text[2:].replace(' ', '')
+    if is_long:
+        text = text[:-4]
+    return text
+
+
+def parse_card(sel):
+    """解析一张微博卡片，返回(微博, 被转发微博)，均为字段顺序与WeiboItem一致的dict，没有被转发微博时后者为None。
+    卡片不是微博时返回None"""
+    info = INFO(sel)
+    if not info:
+        return None
+    weibo = {}
+    weibo['id'] = sel.get('mid')
+    try:
+        weibo['bid'] = first(BID_P(sel)).split('/')[-1].split('?')[0]
+    except AttributeError:
+        weibo['bid'] = first(BID_DIV(sel)).split('/')[-1].split('?')[0]
+    weibo['user_id'] = first(USER_HREF(info[0])).split('?')[0].split('/')[-1]
+    weibo['screen_name'] = first(NICK_NAME(info[0]))
+    txt_sel = TXT(sel)[0]
+    retweet_sel = RETWEET(sel)
+    retweet_txt_sel = ''
+    if retweet_sel:
+        retweet_txt = TXT(retweet_sel[0])
+        if retweet_txt:
+            retweet_txt_sel = retweet_txt[0]
+    content_full = CONTENT_FULL(sel)
+    is_long_weibo = False
+    is_long_retweet = False
+    if content_full:
+        if not retweet_sel:
+            txt_sel = content_full[0]
+            is_long_weibo = True
+        elif len(content_full) == 2:
+            txt_sel = content_full[0]
+            retweet_txt_sel = content_full[1]
+            is_long_weibo = True
+            is_long_retweet = True
+        else:
+            retweet_full = CONTENT_FULL(retweet_sel[0])
+            if retweet_full:
+                retweet_txt_sel = retweet_full[0]
+                is_long_retweet = True
+            else:
+                txt_sel = content_full[0]
+                is_long_weibo = True
+    article_url, location, at_users, topics = parse_txt(txt_sel)
+    weibo['text'] = get_text(txt_sel, location, is_long_weibo)
+    weibo['article_url'] = article_url
+    weibo['location'] = location
+    weibo['at_users'] = at_users
+    weibo['topics'] = topics
+    weibo['reposts_count'] = get_count(''.join(REPOSTS(sel)))
+    comments_count = first(COMMENTS(sel))
+    weibo['comments_count'] = get_count(
+        comments_count) if comments_count is not None else '0'
+    weibo['attitudes_count'] = get_count(first(ATTITUDES(sel)))
+    created_at = first(CREATED_AT_P(sel))
+    if created_at is None:
+        created_at = first(CREATED_AT_DIV(sel))
+    created_at = created_at.replace(' ', '').replace('\n', '').split('前')[0]
+    weibo['created_at'] = standardize_date(created_at)
+    source = first(SOURCE_P(sel))
+    weibo['source'] = source if source else ''
+    pics = ''
+    is_exist_pic = PICLIST(sel)
+    if is_exist_pic:
+        pics = [
+            'https://' + PIC_SIZE.sub('/large/', pic[8:], 1)
+            for pic in PICS(is_exist_pic[0])
+        ]
+    video_url = ''
+    is_exist_video = VIDEO(sel)
+    if is_exist_video:
+        video_url = VIDEO_SRC.findall(
+            etree.tostring(is_exist_video[0],
+                           method='html',
+                           encoding='unicode',
+                           with_tail=False))[0]
+        video_url = video_url.replace('&amp;', '&')
+        video_url = 'http:' + video_url
+    if not retweet_sel:
+        weibo['pics'] = pics
+        weibo['video_url'] = video_url
+    else:
+        weibo['pics'] = ''
+        weibo['video_url'] = ''
+    weibo['retweet_id'] = ''
+    retweet = None
+    if retweet_sel and RETWEET_INFO(retweet_sel[0]):
+        retweet_sel = retweet_sel[0]
+        retweet = {}
+        retweet['id'] = first(RETWEET_ID(retweet_sel))[4:]
+        try:
+            retweet['bid'] = first(RETWEET_BID_P(retweet_sel)).split(
+                '/')[-1].split('?')[0]
+        except AttributeError:
+            retweet['bid'] = first(RETWEET_BID_DIV(retweet_sel)).split(
+                '/')[-1].split('?')[0]
+        info = RETWEET_INFO(retweet_sel)[0]
+        retweet['user_id'] = info.get('href').split('/')[-1]
+        retweet['screen_name'] = info.get('nick-name')
+        article_url, location, at_users, topics = parse_txt(retweet_txt_sel)
+        retweet['text'] = get_text(retweet_txt_sel, location, is_long_retweet)
+        retweet['article_url'] = article_url
+        retweet['location'] = location
+        retweet['at_users'] = at_users
+        retweet['topics'] = topics
+        retweet['reposts_count'] = get_count(
+            first(RETWEET_REPOSTS(retweet_sel)))
+        retweet['comments_count'] = get_count(
+            first(RETWEET_COMMENTS(retweet_sel)))
+        retweet['attitudes_count'] = get_count(
+            first(RETWEET_ATTITUDES(retweet_sel)))
+        created_at = first(CREATED_AT_P(retweet_sel)).replace(' ', '').replace(
+            '\n', '').split('前')[0]
+        retweet['created_at'] = standardize_date(created_at)
+        source = first(SOURCE_P(retweet_sel))
+        retweet['source'] = source if source else ''
+        retweet['pics'] = pics
+        retweet['video_url'] = video_url
+        retweet['retweet_id'] = ''
+        weibo['retweet_id'] = retweet['id']
+    return weibo, retweet
+
+
+def parse_cards(root):
+    """解析搜索结果页中的全部微博卡片，root为页面的lxml根元素"""
+    for sel in CARDS(root):
+        result = parse_card(sel)
+        if result:
+            yield result
+
+
+def parse_page(root):
+    """解析搜索结果页的概况，返回是否为空、总页数、时间范围说明和下一页链接"""
+    return {
+        'is_empty': bool(EMPTY(root)),
+        'page_count': len(PAGES(root)),
+        'period': first(PERIOD(root)),
+        'next_url': first(NEXT(root))
+    }
+
+
+def parse_text(text):
+    """解析整个搜索结果页，返回parse_page的结果及全部微博卡片，只包含可序列化的对象，供子进程调用"""
+    root = Selector(text=text, type='html').root
+    result = parse_page(root)
+    result['cards'] = [] if result['is_empty'] else list(parse_cards(root))
+    return result
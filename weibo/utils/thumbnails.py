@@ -0,0 +1,113 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from twisted.internet import defer, reactor
+
+from weibo.utils.dedup import make_dirs
+
+
+def derivative_path(sha1, folder, image_format):
+    """返回内容为sha1的图片的缩略图或WebP文件的保存路径，如结果文件/media/thumbs/small/ab/abcdef....jpg"""
+    suffix = '.webp' if image_format == 'WEBP' else '.jpg'
+    return '/'.join(['结果文件', 'media', folder, sha1[:2], sha1 + suffix])
+
+
+def convert_image(image, image_format):
+    """把图片转换为目标格式支持的模式，JPEG不支持透明，透明背景转为白色"""
+    if image.mode == 'RGB' or (image_format == 'WEBP'
+                               and image.mode == 'RGBA'):
+        return image
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (
+        image.mode == 'P' and 'transparency' in image.info)
+    if not has_alpha:
+        return image.convert('RGB')
+    image = image.convert('RGBA')
+    if image_format == 'WEBP':
+        return image
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, image)
+    return background
+
+
+def save_image(image, full_path, image_format, quality):
+    """先写入临时文件再改名，中断时不会留下不完整的图片，临时文件名包含进程号，多个进程可以同时处理同一图片"""
+    make_dirs(full_path)
+    tmp_path = '%s.%d.tmp' % (full_path, os.getpid())
+    image.save(tmp_path, image_format, quality=quality)
+    os.replace(tmp_path, full_path)
+
+
+def transcode(base_dir, path, sha1, thumbs, webp, quality, drop_original):
+    """在工作进程中生成缩略图和WebP文件，已存在的文件不再生成。
+    返回替代原图的文件路径，不丢弃原图或图片为动图时返回原图路径"""
+    image_format = 'WEBP' if webp else 'JPEG'
+    outputs = [(derivative_path(sha1, 'thumbs/' + name, image_format), size)
+               for name, size in thumbs.items()]
+    if webp:
+        # 与原图尺寸相同的WebP文件
+        outputs.append((derivative_path(sha1, 'webp', 'WEBP'), None))
+    src = os.path.join(base_dir, path)
+    missing = [(output, size) for output, size in outputs
+               if not os.path.isfile(os.path.join(base_dir, output))]
+    if missing:
+        with Image.open(src) as image:
+            if getattr(image, 'is_animated', False):
+                return path
+            image = convert_image(image, image_format)
+            for output, size in missing:
+                if size:
+                    thumb = image.copy()
+                    thumb.thumbnail(size, Image.LANCZOS)
+                else:
+                    thumb = image
+                save_image(thumb, os.path.join(base_dir, output),
+                           image_format, quality)
+    if not drop_original or not outputs:
+        return path
+    if os.path.isfile(src):
+        os.remove(src)
+    if webp:
+        return outputs[-1][0]
+    # 只生成缩略图时以最大的缩略图代替原图
+    return max(outputs, key=lambda output: output[1][0] * output[1][1])[0]
+
+
+class ImageTranscoder(object):
+    """用进程池在reactor线程之外生成缩略图和WebP文件，thumbs为{名称: (宽, 高)}，
+    webp为True时缩略图也保存为WebP，drop_original为True时删除原图"""
+
+    def __init__(self,
+                 base_dir,
+                 thumbs,
+                 webp=False,
+                 quality=80,
+                 drop_original=False,
+                 processes=None):
+        self.base_dir = base_dir
+        self.thumbs = dict(thumbs)
+        self.webp = webp
+        self.quality = quality
+        self.drop_original = drop_original
+        self.executor = ProcessPoolExecutor(processes)
+
+    def submit(self, path, sha1):
+        """处理FILES_STORE下的图片path，返回以替代原图的路径触发的Deferred"""
+        d = defer.Deferred()
+        future = self.executor.submit(transcode, self.base_dir, path, sha1,
+                                      self.thumbs, self.webp, self.quality,
+                                      self.drop_original)
+        future.add_done_callback(
+            lambda future: reactor.callFromThread(self.done, future, d))
+        return d
+
+    def done(self, future, d):
+        try:
+            result = future.result()
+        except Exception as e:
+            d.errback(e)
+        else:
+            d.callback(result)
+
+    def close(self):
+        self.executor.shutdown()
@@ -1,5 +1,9 @@
+import re
 import sys
+from collections import deque
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import islice
 
 from weibo.utils.region import region_dict
 
@@ -100,7 +104,102 @@ def standardize_date(created_at):
     return created_at
 
 
+COUNT = re.compile(r'(\d+(?:\.\d+)?)\s*(万|亿)?')
+UNITS = {'万': 10000, '亿': 100000000}
+
+
+def normalize_count(text):
+    """把转发、评论、点赞数转换成整数，如'1万+'转换成10000，'1.2亿'转换成120000000，没有数字时返回0"""
+    if isinstance(text, int):
+        return text
+    match = COUNT.search(text or '')
+    if not match:
+        return 0
+    count, unit = match.groups()
+    return int(round(float(count) * UNITS.get(unit, 1)))
+
+
+def parse_created_at(text):
+    """把standardize_date得到的发布时间转换成时间类型，无法转换时返回None"""
+    if isinstance(text, datetime):
+        return text
+    try:
+        return datetime.strptime(text, '%Y-%m-%d %H:%M')
+    except (TypeError, ValueError):
+        return None
+
+
 def str_to_time(text):
     """将字符串转换成时间类型"""
     result = datetime.strptime(text, '%Y-%m-%d')
     return result
+
+
+def format_hour(date):
+    """将时间转换成搜索链接中timescope使用的格式，如2020-09-01-13，小时不补零"""
+    return '%04d-%02d-%02d-%d' % (date.year, date.month, date.day, date.hour)
+
+
+@lru_cache(maxsize=65536)
+def format_timescope(start_time, end_time):
+    """生成搜索链接中的timescope参数值，如custom:2020-09-01-13:2020-09-01-14，同一窗口的结果会被缓存"""
+    return 'custom:%s:%s' % (format_hour(start_time), format_hour(end_time))
+
+
+def parse_hour(text):
+    """将format_hour格式的字符串转换成时间类型"""
+    return datetime.strptime(text, '%Y-%m-%d-%H')
+
+
+def get_region_by_code(code):
+    """根据省或直辖市的代码返回region"""
+    for region in region_dict.values():
+        if region['code'] == code:
+            return region
+
+
+def split_time_window(start_time, end_time):
+    """细分搜索时间窗口，多天的窗口按天细分，一天的窗口按小时细分，微博搜索的最小粒度为小时，一小时的窗口返回空列表"""
+    if end_time - start_time > timedelta(days=1):
+        step = timedelta(days=1)
+    elif end_time - start_time > timedelta(hours=1):
+        step = timedelta(hours=1)
+    else:
+        return []
+    windows = []
+    while start_time < end_time:
+        windows.append((start_time, min(start_time + step, end_time)))
+        start_time = start_time + step
+    return windows
+
+
+def time_windows(start_time, end_time, step):
+    """按step依次生成[start_time, end_time)内的搜索时间窗口，最后一个窗口截止于end_time"""
+    while start_time < end_time:
+        window_end = min(start_time + step, end_time)
+        yield start_time, window_end
+        start_time = window_end
+
+
+@lru_cache(maxsize=8)
+def window_table(start_time, end_time, step):
+    """返回[start_time, end_time)内全部搜索时间窗口的元组，每项为(开始时间, 结束时间, timescope参数值)，
+    同一时间范围和粒度只计算一次，供全部关键词和地区共用"""
+    return tuple((start, end, format_timescope(start, end))
+                 for start, end in time_windows(start_time, end_time, step))
+
+
+def interleave(iterables, active_count):
+    """轮流从多个可迭代对象中取值，同时最多只展开active_count个，某个取完后再展开下一个"""
+    iterables = iter(iterables)
+    active = deque(iter(it) for it in islice(iterables, max(active_count, 1)))
+    while active:
+        it = active.popleft()
+        try:
+            value = next(it)
+        except StopIteration:
+            for it in islice(iterables, 1):
+                active.append(iter(it))
+            continue
+        active.append(it)
+        yield value
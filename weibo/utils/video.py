@@ -0,0 +1,109 @@
+import hashlib
+import os
+
+from twisted.internet import defer, reactor, threads
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web.client import (Agent, BrowserLikeRedirectAgent,
+                                HTTPConnectionPool, ResponseDone)
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+
+class VideoError(Exception):
+    pass
+
+
+def file_sha1(file_path):
+    """分块计算文件的sha1，返回sha1对象，供续传时继续计算"""
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1
+
+
+class FileWriter(Protocol):
+    """把响应内容逐块写入文件并计算sha1，不在内存中保存整个视频，超过timeout秒没有收到数据时断开连接"""
+
+    def __init__(self, f, sha1, finished, timeout=30):
+        self.f = f
+        self.sha1 = sha1
+        self.finished = finished
+        self.timeout = timeout
+        self.timer = None
+
+    def connectionMade(self):
+        self.timer = reactor.callLater(self.timeout,
+                                       self.transport.stopProducing)
+
+    def dataReceived(self, data):
+        self.timer.reset(self.timeout)
+        self.f.write(data)
+        self.sha1.update(data)
+
+    def connectionLost(self, reason):
+        self.f.close()
+        if self.timer.active():
+            self.timer.cancel()
+        else:
+            # 超时断开时没有Content-Length的响应也会被当作正常结束，以超时为准
+            reason = Failure(VideoError('%d秒内没有收到数据' % self.timeout))
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.sha1.hexdigest())
+        else:
+            self.finished.errback(reason)
+
+
+class VideoDownloader(object):
+    """用Twisted Agent把视频流式下载到.part文件，已存在的.part文件通过HTTP Range续传，
+    同时下载的视频数不超过concurrency，与页面请求的并发数分开计算，连接、等待响应和两次收到数据的间隔都不超过timeout秒"""
+
+    def __init__(self, concurrency=2, user_agent=None, timeout=30):
+        pool = HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = concurrency
+        self.agent = BrowserLikeRedirectAgent(
+            Agent(reactor, connectTimeout=timeout, pool=pool))
+        self.pool = pool
+        self.timeout = timeout
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.user_agent = user_agent
+
+    def download(self, url, part_path):
+        """下载url到part_path，返回以文件内容的sha1触发的Deferred，下载失败时保留.part文件供下次续传"""
+        return self.semaphore.run(self.fetch, url, part_path)
+
+    @defer.inlineCallbacks
+    def fetch(self, url, part_path):
+        offset = os.path.getsize(part_path) if os.path.isfile(
+            part_path) else 0
+        headers = Headers()
+        if self.user_agent:
+            headers.addRawHeader(b'User-Agent', self.user_agent.encode())
+        if offset:
+            headers.addRawHeader(b'Range', b'bytes=%d-' % offset)
+        d = self.agent.request(b'GET', url.encode(), headers)
+        d.addTimeout(self.timeout, reactor)
+        response = yield d
+        if response.code == 416 and offset:
+            # .part文件已经完整
+            response.deliverBody(Protocol())
+            sha1 = yield threads.deferToThread(file_sha1, part_path)
+            return sha1.hexdigest()
+        if response.code == 206 and offset:
+            sha1 = yield threads.deferToThread(file_sha1, part_path)
+            f = open(part_path, 'ab')
+        elif response.code == 200:
+            # 服务器不支持Range时重新下载
+            sha1 = hashlib.sha1()
+            f = open(part_path, 'wb')
+        else:
+            response.deliverBody(Protocol())
+            raise VideoError('HTTP %d' % response.code)
+        finished = defer.Deferred()
+        response.deliverBody(FileWriter(f, sha1, finished, self.timeout))
+        digest = yield finished
+        return digest
+
+    def close(self):
+        return self.pool.closeCachedConnections()
@@ -0,0 +1,139 @@
+import json
+import sqlite3
+import time
+from itertools import islice
+
+from weibo.utils.dedup import make_dirs
+
+
+class SqliteWorkQueue(object):
+    """多个进程共用的SQLite搜索任务队列，每个任务为(关键词, 地区, 时间范围)，适用于同一台机器上的多个爬虫进程。
+    领取的任务在lease_timeout秒内未完成时可被其它进程重新领取"""
+
+    def __init__(self, file_path, lease_timeout=1800):
+        make_dirs(file_path)
+        # 由程序显式开启事务，BEGIN IMMEDIATE保证领取任务时不会与其它进程冲突
+        self.db = sqlite3.connect(file_path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS units (
+            keyword TEXT NOT NULL,
+            region TEXT NOT NULL,
+            timescope TEXT NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            claimed_at REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (keyword, region, timescope)
+            )""")
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS units_claim ON units (done, claimed_at)')
+        self.lease_timeout = lease_timeout
+
+    def seed(self, units, batch_size=1000):
+        """按顺序添加任务，已存在的任务（包括已完成的）保持不变，每个进程都可以重复添加。
+        每batch_size个任务提交一次，其它进程在添加期间也能领取任务"""
+        units = iter(units)
+        while True:
+            batch = list(islice(units, batch_size))
+            if not batch:
+                return
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.executemany(
+                'INSERT OR IGNORE INTO units (keyword, region, timescope) VALUES (?, ?, ?)',
+                batch)
+            self.db.execute('COMMIT')
+
+    def claim(self):
+        """领取一个未完成且未被领取（或领取已超时）的任务，没有任务时返回None"""
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        # 索引中未领取的任务按添加顺序排列，其后为最早超时的任务
+        row = self.db.execute(
+            'SELECT keyword, region, timescope FROM units WHERE done = 0 AND claimed_at < ? ORDER BY claimed_at, rowid LIMIT 1',
+            (now - self.lease_timeout, )).fetchone()
+        if row:
+            self.db.execute(
+                'UPDATE units SET claimed_at = ? WHERE keyword = ? AND region = ? AND timescope = ?',
+                (now, ) + row)
+        self.db.execute('COMMIT')
+        return row
+
+    def finish(self, unit):
+        """把任务标记为已完成"""
+        self.db.execute(
+            'UPDATE units SET done = 1 WHERE keyword = ? AND region = ? AND timescope = ?',
+            unit)
+
+    def close(self):
+        self.db.close()
+
+
+# 把从未添加过的任务加入已添加集合并放入队列，两步在Redis中原子地执行，进程在添加途中退出也不会丢失任务
+SEED_SCRIPT = """
+for _, key in ipairs(ARGV) do
+    if redis.call('SADD', KEYS[1], key) == 1 then
+        redis.call('RPUSH', KEYS[2], key)
+    end
+end
+"""
+
+# 把超时的任务放回队列并领取一个任务，在Redis中原子地执行，进程在领取途中退出也不会丢失任务
+CLAIM_SCRIPT = """
+local now = tonumber(ARGV[1])
+for _, key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], 0, now - tonumber(ARGV[2]))) do
+    redis.call('ZREM', KEYS[2], key)
+    redis.call('RPUSH', KEYS[1], key)
+end
+local key = redis.call('LPOP', KEYS[1])
+if key then
+    redis.call('ZADD', KEYS[2], ARGV[1], key)
+end
+return key
+"""
+
+
+class RedisWorkQueue(object):
+    """保存在Redis中的搜索任务队列，可供多台机器上的爬虫进程共用，name为键名前缀。
+    领取的任务在lease_timeout秒内未完成时会被放回队列"""
+
+    def __init__(self, url, name='weibo', lease_timeout=1800):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.seen_key = name + ':seen'
+        self.pending_key = name + ':pending'
+        self.leases_key = name + ':leases'
+        self.lease_timeout = lease_timeout
+        self.seed_script = self.redis.register_script(SEED_SCRIPT)
+        self.claim_script = self.redis.register_script(CLAIM_SCRIPT)
+
+    def seed(self, units, batch_size=1000):
+        """按顺序添加任务，曾经添加过的任务（包括已完成的）不再添加，每个进程都可以重复添加"""
+        units = iter(units)
+        while True:
+            batch = [json.dumps(unit) for unit in islice(units, batch_size)]
+            if not batch:
+                return
+            self.seed_script(keys=[self.seen_key, self.pending_key],
+                             args=batch)
+
+    def claim(self):
+        """领取一个任务，没有任务时返回None，领取前先把超时的任务放回队列"""
+        key = self.claim_script(keys=[self.pending_key, self.leases_key],
+                                args=[time.time(), self.lease_timeout])
+        if key is None:
+            return None
+        return tuple(json.loads(key))
+
+    def finish(self, unit):
+        """把任务标记为已完成"""
+        self.redis.zrem(self.leases_key, json.dumps(list(unit)))
+
+    def close(self):
+        self.redis.close()
+
+
+def get_work_queue(url, name='weibo', lease_timeout=1800):
+    """根据WORK_QUEUE返回任务队列，redis://开头的地址使用Redis，其余视为SQLite文件路径"""
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisWorkQueue(url, name, lease_timeout)
+    return SqliteWorkQueue(url, lease_timeout)